@@ -4,10 +4,83 @@ Created on Sun May 7 01:18:16 2023
 
 @author: Molly Ross
 """
+import os
+import json
+import hashlib
+import tempfile
 import numpy as np
+from functools import partial
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy.sparse import csr_matrix, issparse
 
+# Revision of the KM estimator, part of the cache key so that results
+# cached by an older estimator are not reused
+KM_REVISION = 2
+
+
+def normalize_rows(counts):
+    """
+    Convert transition counts to probabilities by dividing every row by its
+    sum. Rows without any transitions stay zero.
+
+    Parameters
+    ----------
+    counts : TYPE: numpy.ndarray or scipy.sparse.csr_matrix
+        Transition counts. Dense arrays are normalized along the last axis.
+
+    Returns
+    -------
+    TYPE: numpy.ndarray or scipy.sparse.csr_matrix with dtype=float
+        Transition probabilities in the same format as counts.
+
+    """
+    if issparse(counts):
+        M = csr_matrix(counts,dtype=float)
+        s = np.asarray(M.sum(axis=1)).ravel()
+        M.data /= np.repeat(s,np.diff(M.indptr))
+        return M
+    s = np.sum(counts,axis=-1,keepdims=True)
+    return np.divide(counts,s,out=np.zeros(np.shape(counts)),where=s>0)
+
+def transition_counts(ts_dig,tau,n=None,sparse=False):
+    """
+    Counts the transitions of a digitized time series without normalizing
+    them to probabilities.
+
+    Parameters
+    ----------
+    ts_dig : TYPE: numpy.ndarray with dtype=int64
+        Time series digitized to the bin number with N bins.
+    tau : TYPE: integer
+        Number of time shifts to the next value.
+    n : TYPE: integer
+        Number of states. The default is None, which uses 1+max(ts_dig).
+    sparse : TYPE: boolean
+        Return a scipy.sparse.csr_matrix that only stores observed
+        transitions. The default is False.
+
+    Returns
+    -------
+    counts : TYPE: NxN numpy.ndarray with dtype=int64
+        Number of observed transitions from bin i (rows) to bin j (columns)
+        after tau time steps.
 
-def transition_matrix(ts_dig,tau):
+    """
+    ts_dig = np.asarray(ts_dig,dtype=np.int64)
+    if n is None:
+        n = 1+ int(np.max(ts_dig)) # Number of states
+    src = ts_dig[:max(len(ts_dig)-tau,0)]
+    dst = ts_dig[tau:]
+
+    if sparse:
+        # Duplicate (i,j) entries are summed when building the matrix
+        ones = np.ones(len(src),dtype=np.int64)
+        return csr_matrix((ones,(src,dst)),shape=(n,n))
+    # Count all (i,j) pairs at once by flattening them to a single index
+    return np.bincount(src*n + dst,minlength=n*n).reshape(n,n)
+
+def transition_matrix(ts_dig,tau,return_counts=False,n=None,sparse=False):
     """
     Finds the transition matrix of a digitized time series.
 
@@ -17,29 +90,233 @@ def transition_matrix(ts_dig,tau):
         Time series digitized to the bin number with N bins.
     tau : TYPE: integer
         Number of time shifts to the next value.
+    return_counts : TYPE: boolean
+        Also return the raw integer transition counts. The default is False.
+    n : TYPE: integer
+        Number of states. The default is None, which uses 1+max(ts_dig).
+    sparse : TYPE: boolean
+        Return scipy.sparse.csr_matrix objects that only store observed
+        transitions. The default is False.
 
     Returns
     -------
     TYPE: NxN numpy.ndarray with dtype=float
         Transition matrix describing probability of going from bin i (rows)
         to bin j (columns) after tau time steps.
+    counts : TYPE: NxN numpy.ndarray with dtype=int64
+        Number of observed transitions from bin i to bin j. Only returned
+        when return_counts is True.
+
+    """
+    counts = transition_counts(ts_dig,tau,n=n,sparse=sparse)
+
+    # Convert to Fractions:
+    M = normalize_rows(counts)
+    if return_counts:
+        return M, counts
+    return M
 
+def transition_counts_cube(ts_dig,taus,n=None):
     """
-    n = 1+ max(ts_dig) # Number of states
+    Counts the transitions of a digitized time series for several time
+    shifts at once without normalizing them to probabilities.
 
-    M = [[0]*n for _ in range(n)] # Initiate transition probability matrix
+    Parameters
+    ----------
+    ts_dig : TYPE: numpy.ndarray with dtype=int64
+        Time series digitized to the bin number with N bins.
+    taus : TYPE: numpy.ndarray with dtype=int
+        Time shifts to count transitions for.
+    n : TYPE: integer
+        Number of states. The default is None, which uses 1+max(ts_dig).
+
+    Returns
+    -------
+    counts : TYPE: len(taus)xNxN numpy.ndarray with dtype=int64
+        Number of observed transitions for each time shift.
+
+    """
+    ts_dig = np.asarray(ts_dig,dtype=np.int64)
+    taus = np.atleast_1d(np.asarray(taus,dtype=np.int64))
+    if n is None:
+        n = 1+ int(np.max(ts_dig))
+
+    # Row index of every sample is shared by all time shifts
+    rows = ts_dig*n
+    counts = np.zeros((len(taus),n,n),dtype=np.int64)
+    for l,tau in enumerate(taus):
+        pairs = rows[:max(len(ts_dig)-tau,0)] + ts_dig[tau:]
+        counts[l] = np.bincount(pairs,minlength=n*n).reshape(n,n)
+    return counts
+
+def transition_cube(ts_dig,taus,n=None,return_counts=False):
+    """
+    Finds the transition matrices of a digitized time series for several
+    time shifts at once.
+
+    Parameters
+    ----------
+    ts_dig : TYPE: numpy.ndarray with dtype=int64
+        Time series digitized to the bin number with N bins.
+    taus : TYPE: numpy.ndarray with dtype=int
+        Time shifts to compute transition matrices for.
+    n : TYPE: integer
+        Number of states. The default is None, which uses 1+max(ts_dig).
+    return_counts : TYPE: boolean
+        Also return the raw integer transition counts. The default is False.
+
+    Returns
+    -------
+    TYPE: len(taus)xNxN numpy.ndarray with dtype=float
+        Transition matrices stacked along the first axis, one per time shift.
+    counts : TYPE: len(taus)xNxN numpy.ndarray with dtype=int64
+        Number of observed transitions for each time shift. Only returned
+        when return_counts is True.
+
+    """
+    counts = transition_counts_cube(ts_dig,taus,n=n)
 
-    for (i,j) in zip(ts_dig,ts_dig[tau:]):
-        M[i][j] += 1
-    
     # Convert to Fractions:
-    for row in M:
-        s = sum(row)
-        if s > 0:
-            row[:] = [f/s for f in row]
-    return np.asarray(M)
+    M = normalize_rows(counts)
+    if return_counts:
+        return M, counts
+    return M
+
+def conditional_moments(ts_dig,taus,num_bins,dx,return_counts=False,
+                        sparse=False):
+    """
+    Calculate the first and second conditional moments of the increments of
+    a digitized time series for several time shifts.
+
+    Parameters
+    ----------
+    ts_dig : TYPE: numpy.ndarray with dtype=int64
+        Time series digitized with numpy.digitize against num_bins bin edges
+        (states 0 to num_bins).
+    taus : TYPE: numpy.ndarray with dtype=int
+        Time shifts to compute the moments for.
+    num_bins : TYPE: integer
+        Number of bins.
+    dx : TYPE: float
+        Bin width. Increments are summed as whole numbers of bins and only
+        then scaled by dx, so moments whose increments cancel are exactly
+        zero whatever the summation order.
+    return_counts : TYPE: boolean
+        Also return the number of transitions leaving each bin.
+        The default is False.
+    sparse : TYPE: boolean
+        Use sparse transition matrices, one lag at a time, so memory scales
+        with the number of observed transitions. The default is False.
+
+    Returns
+    -------
+    M1 : TYPE: len(taus)xnum_bins numpy.ndarray
+        First conditional moment <x(t+tau)-x(t) | x(t)> for each time shift
+        (rows) and bin (columns).
+    M2 : TYPE: len(taus)xnum_bins numpy.ndarray
+        Second conditional moment <(x(t+tau)-x(t))**2 | x(t)>.
+    counts : TYPE: len(taus)xnum_bins numpy.ndarray with dtype=int64
+        Number of transitions leaving each bin. Only returned when
+        return_counts is True.
+
+    """
+    ts_dig = np.asarray(ts_dig,dtype=np.int64)
+    taus = np.atleast_1d(taus)
+    if sparse:
+        S1 = np.zeros((len(taus),num_bins))
+        S2 = np.zeros((len(taus),num_bins))
+        c = np.zeros((len(taus),num_bins),dtype=np.int64)
+        for l,tau in enumerate(taus):
+            counts = transition_counts(ts_dig,tau,n=num_bins+1,sparse=True)
+
+            # Values below the first bin edge (state 0) are dropped
+            m = counts[1:,1:].tocoo()
+            inc = m.col - m.row
+            S1[l] = np.bincount(m.row,weights=m.data*inc,minlength=num_bins)
+            S2[l] = np.bincount(m.row,weights=m.data*inc*inc,minlength=num_bins)
+            c[l] = np.asarray(counts[1:].sum(axis=1)).ravel()
+    else:
+        counts = transition_counts_cube(ts_dig,taus,n=num_bins+1)
+
+        # Values below the first bin edge (state 0) are dropped
+        states = np.arange(num_bins)
+        offset = states[np.newaxis,:] - states[:,np.newaxis]
+        S1 = np.einsum('lij,ij->li',counts[:,1:,1:],offset)
+        S2 = np.einsum('lij,ij->li',counts[:,1:,1:],offset*offset)
+        c = np.sum(counts[:,1:,:],axis=2)
+    M1 = np.divide(dx*S1,c,out=np.zeros(S1.shape),where=c>0)
+    M2 = np.divide(dx*dx*S2,c,out=np.zeros(S2.shape),where=c>0)
+    if return_counts:
+        return M1, M2, c
+    return M1, M2
+
+def moment_sums(ts_dig,taus,num_bins,dest_start=0,src_stop=None):
+    """
+    Accumulate per-bin transition counts and sums of increments for several
+    time shifts without forming the NxN transition matrix. Increments are
+    counted in whole bins, so the sums are exact whatever order data is
+    added in; scale S1 by dx and S2 by dx**2 for physical units.
+    Every column of ts_dig is treated as an independent time series.
+
+    Parameters
+    ----------
+    ts_dig : TYPE: numpy.ndarray with dtype=int64
+        Time series digitized with numpy.digitize against num_bins bin
+        edges. Either 1D (time) or 2D (time x columns).
+    taus : TYPE: numpy.ndarray with dtype=int
+        Time shifts to accumulate.
+    num_bins : TYPE: integer
+        Number of bins.
+    dest_start : TYPE: integer
+        Only count transitions ending at or after this index, e.g. to skip
+        samples that were already accumulated. The default is 0.
+    src_stop : TYPE: integer
+        Only count transitions starting before this index. The default is
+        None (no limit).
+
+    Returns
+    -------
+    counts : TYPE: columnsxlen(taus)xbins numpy.ndarray with dtype=int64
+        Number of transitions leaving each bin.
+    S1 : TYPE: columnsxlen(taus)xbins numpy.ndarray
+        Sum of the increments for each bin, in bins.
+    S2 : TYPE: columnsxlen(taus)xbins numpy.ndarray
+        Sum of the squared increments for each bin, in bins squared.
 
-def findQ(ts_raw, lam_bins = 10, numPeriods=3,tau=20):
+    """
+    ts_dig = np.asarray(ts_dig,dtype=np.int64)
+    if ts_dig.ndim == 1:
+        ts_dig = ts_dig[:,np.newaxis]
+    taus = np.atleast_1d(np.asarray(taus,dtype=np.int64))
+    N, C = np.shape(ts_dig)
+    n = num_bins+1
+
+    # State 0 (below the first bin edge) has no center and is given a zero
+    # increment as a destination, but still counts as a transition
+    state = ts_dig + n*np.arange(C)
+    inside = ts_dig > 0
+
+    counts = np.zeros((len(taus),C*n),dtype=np.int64)
+    S1 = np.zeros((len(taus),C*n))
+    S2 = np.zeros((len(taus),C*n))
+    if src_stop is None:
+        src_stop = N
+    for l,tau in enumerate(taus):
+        lo = max(dest_start-tau,0)
+        hi = max(min(N-tau,src_stop),lo)
+        src = state[lo:hi].ravel()
+        inc = ((ts_dig[lo+tau:hi+tau]-ts_dig[lo:hi])*inside[lo+tau:hi+tau]).ravel()
+        counts[l] = np.bincount(src,minlength=C*n)
+        S1[l] = np.bincount(src,weights=inc,minlength=C*n)
+        S2[l] = np.bincount(src,weights=inc*inc,minlength=C*n)
+
+    shape = (len(taus),C,n)
+    counts = np.moveaxis(counts.reshape(shape),1,0)[:,:,1:]
+    S1 = np.moveaxis(S1.reshape(shape),1,0)[:,:,1:]
+    S2 = np.moveaxis(S2.reshape(shape),1,0)[:,:,1:]
+    return counts, S1, S2
+
+def findQ(ts_raw, lam_bins = 10, numPeriods=3,tau=20,sparse=False):
     """
     Calculate the Chi Square Statistic for transition probability of various
     sections of the data
@@ -56,6 +333,9 @@ def findQ(ts_raw, lam_bins = 10, numPeriods=3,tau=20):
         the Chi Square (Q) statistic. The default is 3.
     tau : TYPE, integer
         Time shift for calculating transition probability. The default is 20.
+    sparse : TYPE, boolean
+        Use sparse transition matrices and sum only over observed
+        transitions. The default is False.
 
     Returns
     -------
@@ -66,22 +346,79 @@ def findQ(ts_raw, lam_bins = 10, numPeriods=3,tau=20):
     """
     bins = np.linspace(np.min(ts_raw),np.max(ts_raw))
     ts_dig = np.digitize(ts_raw,bins)
-    transMatrix = transition_matrix(ts_dig,tau = tau)
-    splitMatrices = [] # Divide the time series into sub-series
-    for i in range(numPeriods):
-        splitMatrices.append(transition_matrix(ts_dig[int(i*len(ts_dig)/numPeriods):int((i+1)*len(ts_dig)/numPeriods)],tau=tau))
-
-    Q=0
-    for i in range(numPeriods):
-        for j in range(lam_bins):
-            rowsumt = sum(splitMatrices[i][j])
-            for k in range(lam_bins):
-                if transMatrix[j][k]>0:
-                    Q = Q+((rowsumt*((splitMatrices[i][j][k]-transMatrix[j][k])**2))/(transMatrix[j][k]))
+    return findQ_dig(ts_dig,lam_bins=lam_bins,numPeriods=numPeriods,tau=tau,
+                     sparse=sparse)
+
+def findQ_dig(ts_dig, lam_bins = 10, numPeriods=3,tau=20,sparse=False):
+    """
+    Calculate the Chi Square Statistic for transition probability of various
+    sections of an already digitized time series.
+
+    Parameters
+    ----------
+    ts_dig : TYPE: numpy.ndarray with dtype=int64
+        Time series digitized to the bin number.
+    lam_bins : TYPE, integer.
+        Number of states included in the statistic. The default is 10.
+    numPeriods : TYPE, integer
+        Number of sections the time series will be divided into to calculate
+        the Chi Square (Q) statistic. The default is 3.
+    tau : TYPE, integer
+        Time shift for calculating transition probability. The default is 20.
+    sparse : TYPE, boolean
+        Use sparse transition matrices and sum only over observed
+        transitions. The default is False.
+
+    Returns
+    -------
+    Q : TYPE, float.
+        Chi-square statistic for the transition probabilities of the divided
+        time series.
+
+    """
+    ts_dig = np.asarray(ts_dig,dtype=np.int64)
+    N = len(ts_dig)
+    transMatrix = transition_matrix(ts_dig,tau = tau,sparse = sparse)
+    n = np.shape(transMatrix)[0]
+
+    # Divide the time series into sub-series and count the transitions of
+    # every section at once. A pair only counts if both ends share a section.
+    edges = np.array([int(i*N/numPeriods) for i in range(numPeriods+1)])
+    start = np.arange(max(N-tau,0))
+    period = np.searchsorted(edges,start,side='right')-1
+    valid = start+tau < edges[period+1]
+    src = period[valid]*n + ts_dig[start[valid]]
+    dst = ts_dig[start[valid]+tau]
+
+    if sparse:
+        # Sections are stacked as blocks of n rows
+        ones = np.ones(len(src),dtype=np.int64)
+        counts = csr_matrix((ones,(src,dst)),shape=(numPeriods*n,n))
+        splitMatrices = normalize_rows(counts)
+        rowsumt = np.asarray(splitMatrices.sum(axis=1)).reshape(numPeriods,n)
+        trans = transMatrix[:lam_bins,:lam_bins].tocoo()
+        if trans.nnz == 0:
+            # no transitions between the first states, as for the dense sum
+            return 0.0
+        rows = (np.arange(numPeriods)[:,np.newaxis]*n + trans.row).ravel()
+        cols = np.tile(trans.col,numPeriods)
+        split = np.asarray(splitMatrices[rows,cols]).reshape(numPeriods,-1)
+        terms = (split-trans.data)**2/trans.data
+        return np.sum(rowsumt[:,trans.row]*terms)
+
+    counts = np.bincount(src*n + dst,minlength=numPeriods*n*n)
+    splitMatrices = normalize_rows(counts.reshape(numPeriods,n,n))
+
+    rowsumt = np.sum(splitMatrices[:,:lam_bins,:],axis=2)
+    trans = transMatrix[:lam_bins,:lam_bins]
+    diff2 = (splitMatrices[:,:lam_bins,:lam_bins]-trans)**2
+    terms = np.divide(diff2,trans,out=np.zeros(diff2.shape),where=trans>0)
+    Q = np.sum(rowsumt[:,:,np.newaxis]*terms)
     return Q
 
 
-def findLambda(data,lam_bins=10,numPeriods=10,maxOffset=50):
+def findLambda(data,lam_bins=10,numPeriods=10,maxOffset=50,workers=1,
+               executor='process',sparse=False):
     """
     Find the time scale (Lambda) in time steps that preserves the Markov
     property.
@@ -98,6 +435,14 @@ def findLambda(data,lam_bins=10,numPeriods=10,maxOffset=50):
     maxOffset : TYPE, integer.
         The maximum number of time offsets to calculate before stopping.
         The default is 50.
+    workers : TYPE, integer.
+        Number of workers used to evaluate the offsets in parallel. The
+        default is 1, which runs serially.
+    executor : TYPE, string.
+        Pool used when workers > 1, either 'process' or 'thread'.
+        The default is 'process'.
+    sparse : TYPE, boolean
+        Use sparse transition matrices in findQ. The default is False.
 
     Returns
     -------
@@ -106,12 +451,58 @@ def findLambda(data,lam_bins=10,numPeriods=10,maxOffset=50):
 
     """
 
+    # digitize once, the bins do not depend on the offset
+    bins = np.linspace(np.min(data),np.max(data))
+    ts_dig = np.digitize(data,bins)
+
     #find q values over the range of offsets
-    Qs = np.zeros(maxOffset)
-    for i in range(maxOffset):
-        Qs[i] = findQ(data,lam_bins=lam_bins, numPeriods=numPeriods,tau=i+1)
-    
-    offsets = np.arange(maxOffset)
+    if workers > 1:
+        taus = range(1,maxOffset+1)
+        Q_fun = partial(findQ_dig,ts_dig,lam_bins,numPeriods,sparse=sparse)
+        if executor == 'process':
+            pool = ProcessPoolExecutor(max_workers=workers)
+        elif executor == 'thread':
+            pool = ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError("executor must be 'process' or 'thread'")
+        with pool:
+            Qs = np.fromiter(pool.map(Q_fun,taus),dtype=float,count=maxOffset)
+    else:
+        Qs = find_Qs(ts_dig,lam_bins,numPeriods,maxOffset,sparse)
+    return markov_scale(Qs)
+
+def find_Qs(ts_dig,lam_bins=10,numPeriods=10,maxOffset=50,sparse=False):
+    """
+    Calculate the Chi Square Statistic of a digitized time series for every
+    time shift from 1 to maxOffset (see findQ_dig).
+
+    Returns
+    -------
+    Qs : TYPE, numpy array with len = maxOffset
+        Chi-square statistic for each time shift.
+
+    """
+    return np.fromiter((findQ_dig(ts_dig,lam_bins,numPeriods,tau,sparse)
+                        for tau in range(1,maxOffset+1)),
+                       dtype=float,count=maxOffset)
+
+def markov_scale(Qs):
+    """
+    Pick the Markov time scale from the Chi Square Statistic of every time
+    shift, as the first local maximum of log(Q) after its minimum.
+
+    Parameters
+    ----------
+    Qs : TYPE, numpy array
+        Chi-square statistic for the time shifts 1 to len(Qs).
+
+    Returns
+    -------
+    TYPE integer
+        Smallest number of time steps that preserves the Markov condition.
+
+    """
+    offsets = np.arange(len(Qs))
     Qs = np.log(Qs)
     
 
@@ -132,7 +523,87 @@ def findLambda(data,lam_bins=10,numPeriods=10,maxOffset=50):
 
 
 
-def KM(TSeries, lambda_1, dt, num_bins = 200, bin_lims = False):
+def KM_coefficients(M1,M2,taus,dt):
+    """
+    Convert conditional moments to D1 and D2 for each time shift.
+
+    Parameters
+    ----------
+    M1 : TYPE, numpy array with shape (...,len(taus),num_bins)
+        First conditional moment of the increments.
+    M2 : TYPE, numpy array with shape (...,len(taus),num_bins)
+        Second conditional moment of the increments.
+    taus : TYPE, numpy array
+        Time shifts in time steps, starting at lambda_1.
+    dt : TYPE, float
+        Time step size.
+
+    Returns
+    -------
+    D1 : TYPE, numpy array with the shape of M1
+        D1 coefficients for each time shift.
+    D2 : TYPE, numpy array with the shape of M2
+        D2 coefficients for each time shift.
+
+    """
+    # Scaling kept identical to the former lag-by-lag estimate: D1 is divided
+    # by tau*dt twice and the first lag of D2 by 2*tau*dt twice
+    tdt = (np.asarray(taus)*dt)[:,np.newaxis]
+    D1 = M1/(tdt*tdt)
+    D2 = M2/(2*tdt*tdt)
+    D2[...,0,:] = D2[...,0,:]/2
+    return D1, D2
+
+def zero_lag_extrapolation(Tau,D,weights=None,mask=None):
+    """
+    Extrapolate KM coefficients linearly in the time shift to zero. The
+    straight line is fitted to every bin at once by weighted least squares.
+
+    Parameters
+    ----------
+    Tau : TYPE, numpy array
+        Time shift of each row of D.
+    D : TYPE, numpy array with shape (...,len(Tau),num_bins)
+        KM coefficients for each time shift and bin.
+    weights : TYPE, numpy array with the shape of D
+        Weights multiplying the squared residuals, e.g. the number of
+        transitions behind each entry. The default is None (equal weights).
+    mask : TYPE, boolean numpy array with the shape of D
+        Entries used for the fit. The default is None, which uses the
+        non-zero entries of D.
+
+    Returns
+    -------
+    D_e : TYPE, numpy array with shape (...,num_bins)
+        Coefficients extrapolated to zero. Only the masked entries are used
+        for the fit and bins without any are set to zero.
+
+    """
+    D = np.asarray(D,dtype=float)
+    T = np.asarray(Tau,dtype=float)[:,np.newaxis]
+    W = (D!=0 if mask is None else mask).astype(float)
+    if weights is not None:
+        W = W*weights
+    Sw = np.sum(W,axis=-2)
+    zeros = np.zeros(np.shape(Sw))
+
+    # Center on the weighted means so the fit stays well conditioned
+    Tm = np.divide(np.sum(W*T,axis=-2),Sw,out=zeros.copy(),where=Sw>0)
+    Dm = np.divide(np.sum(W*D,axis=-2),Sw,out=zeros.copy(),where=Sw>0)
+    dT = T - Tm[...,np.newaxis,:]
+    Stt = np.sum(W*dT*dT,axis=-2)
+    Std = np.sum(W*dT*(D-Dm[...,np.newaxis,:]),axis=-2)
+    slope = np.divide(Std,Stt,out=zeros.copy(),where=Stt>0)
+    D_e = Dm - slope*Tm
+
+    # With a single lag the line is undetermined and np.polyfit returned the
+    # minimum-norm fit, whose intercept is half the value
+    single = np.count_nonzero(W,axis=-2)==1
+    D_e[single] = Dm[single]/2
+    return D_e
+
+def KM(TSeries, lambda_1, dt, num_bins = 200, bin_lims = False,
+       weighted = False, method = 'matrix', sparse = False):
     """
     Calculate the KM coefficients for a time series
 
@@ -148,6 +619,17 @@ def KM(TSeries, lambda_1, dt, num_bins = 200, bin_lims = False):
         Number of bins to bin the data by. The default is 200.
     bin_lims : TYPE, numpy array with len = 2
         Upper and lower bound for bins. The default is False.
+    weighted : TYPE, boolean
+        Weight the extrapolation to zero by the number of transitions behind
+        each value. The default is False.
+    method : TYPE, string
+        'matrix' builds the transition probability matrix for every lag.
+        'direct' averages the increments per bin without forming the
+        num_binsxnum_bins matrix, which keeps memory linear in num_bins for
+        fine binning. Both give the same result. The default is 'matrix'.
+    sparse : TYPE, boolean
+        Store the transition matrices of the 'matrix' method as sparse
+        matrices. The default is False.
 
     Returns
     -------
@@ -165,44 +647,275 @@ def KM(TSeries, lambda_1, dt, num_bins = 200, bin_lims = False):
         lambda_1 = findLambda(TSeries, lam_bins = 10)
     bins = np.linspace(bin_lims[0],bin_lims[1],num_bins)
     dx = np.mean(np.diff(bins))
-    bin_center = bins + dx/2
-    bins2dx,bins2dy = np.meshgrid(bin_center,bin_center)
-    bins_sub = bins2dx - bins2dy
     TSeries_dig = np.digitize(TSeries,bins)
-    for tau in range(lambda_1,2*lambda_1):
-        m = transition_matrix(TSeries_dig,tau)
-        m = m[1:,1:]
-        D1_pi = (bins_sub*m)/(tau*dt)
-        D2_pi = (bins_sub**2*m)/(2*tau*dt)
-        if 'D1' in locals():
-            D1 = np.vstack([D1,np.sum(D1_pi,axis=1)/(tau*dt)])
-            D2 = np.vstack([D2,np.sum(D2_pi,axis=1)/(tau*dt)])
-        if 'D1' not in locals():
-            D1 = np.sum(D1_pi, axis=1)/(tau*dt)
-            D2 = np.sum(D2_pi, axis=1)/(2*tau*dt)
-    
-    Tau = np.linspace(lambda_1,2*lambda_1,np.shape(D1)[0])
-    D1_e = []
-    D2_e = []
+    taus = np.arange(lambda_1,2*lambda_1)
+    if method == 'matrix':
+        M1, M2, counts = conditional_moments(TSeries_dig,taus,num_bins,dx,
+                                             return_counts=True,sparse=sparse)
+    elif method == 'direct':
+        counts, S1, S2 = moment_sums(TSeries_dig,taus,num_bins)
+        counts, S1, S2 = counts[0], S1[0], S2[0]
+        M1 = np.divide(dx*S1,counts,out=np.zeros(S1.shape),where=counts>0)
+        M2 = np.divide(dx*dx*S2,counts,out=np.zeros(S2.shape),where=counts>0)
+    else:
+        raise ValueError("method must be 'matrix' or 'direct'")
+    D1, D2 = KM_coefficients(M1,M2,taus,dt)
     
     # Extract from calculated tau values to zero
-    for i in range(np.shape(D1)[1]):
-        d1 = D1[:,i]
-        if not np.any(d1):
-            D1_e = np.append(D1_e,0.0)
-        if np.any(d1):
-            idx = np.where(d1!=0)
-            D1fun = np.poly1d(np.polyfit(Tau[idx],d1[idx],1))
-            D1_e = np.append(D1_e,D1fun(0.0))
-        d2 = D2[:,i]
-        if not np.any(d2):
-            D2_e = np.append(D2_e,0.0)
-        if np.any(d2):
-            idx = np.where(d2!=0)
-            D2fun = np.poly1d(np.polyfit(Tau[idx],d2[idx],1))
-            D2_e = np.append(D2_e,D2fun(0.0))
+    Tau = np.linspace(lambda_1,2*lambda_1,len(taus))
+    weights = counts if weighted else None
+    D1_e = zero_lag_extrapolation(Tau,D1,weights,mask=D2!=0)
+    D2_e = zero_lag_extrapolation(Tau,D2,weights)
+    return bins,D1_e,D2_e
+
+def KM_field(TField, lambda_1, dt, num_bins = 200, bin_lims = False,
+             pooled = False, workers = 1, weighted = False):
+    """
+    Calculate the KM coefficients for every column of a time x space field
+    in one batched call.
+
+    Parameters
+    ----------
+    TField : TYPE, 2D numpy array
+        Time series (rows) at every spatial point (columns).
+    lambda_1 : TYPE, integer
+        Markov property number of time steps shared by all columns. If False,
+        the median of findLambda over the columns is used.
+    dt : TYPE, float
+        Time step size.
+    num_bins : TYPE, integer
+        Number of bins to bin the data by. The default is 200.
+    bin_lims : TYPE, numpy array with len = 2 or shape (columns,2)
+        Upper and lower bound for bins. The default is False, which uses the
+        same limits as KM for every column (or for the whole field if pooled).
+    pooled : TYPE, boolean
+        Pool the transitions of all columns into a single set of
+        coefficients. The default is False.
+    workers : TYPE, integer
+        Number of processes the columns are split over. The default is 1.
+    weighted : TYPE, boolean
+        Weight the extrapolation to zero by the number of transitions behind
+        each value. The default is False.
+
+    Returns
+    -------
+    bins : TYPE, numpy array
+        Bins or x values for KM coefficients, columnsxnum_bins
+        (or 1xnum_bins if pooled).
+    D1_e : TYPE, numpy array
+        D1 coefficients extrapolated to zero, same shape as bins.
+    D2_e : TYPE, numpy array
+        D2 coefficients extrapoalted to zero, same shape as bins.
+
+    """
+    TField = np.asarray(TField)
+    C = np.shape(TField)[1]
+    if bin_lims is False:
+        if pooled:
+            bin_lims = [np.min(TField)+np.std(TField),np.max(TField)-np.std(TField)]
+        else:
+            # Reduce along contiguous rows so the limits match KM exactly
+            columns = np.ascontiguousarray(TField.T)
+            std = np.std(columns,axis=1)
+            bin_lims = np.column_stack([np.min(columns,axis=1)+std,
+                                        np.max(columns,axis=1)-std])
+    bin_lims = np.reshape(np.asarray(bin_lims,dtype=float),(-1,2))
+    if lambda_1 is False:
+        # Digitize every column for findLambda once and spread the columns
+        # over the workers
+        lam_dig = [np.digitize(TField[:,c],np.linspace(np.min(TField[:,c]),
+                                                       np.max(TField[:,c])))
+                   for c in range(C)]
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                Qs = list(pool.map(find_Qs,lam_dig,chunksize=max(C//(4*workers),1)))
+        else:
+            Qs = list(map(find_Qs,lam_dig))
+        lambda_1 = int(np.median([markov_scale(Q) for Q in Qs]))
+    bins = np.linspace(bin_lims[:,0],bin_lims[:,1],num_bins,axis=1)
+    dx = np.mean(np.diff(bins,axis=1),axis=1)
+    if len(bins) == 1:
+        TField_dig = np.digitize(TField,bins[0])
+    else:
+        TField_dig = np.column_stack([np.digitize(TField[:,c],bins[c])
+                                      for c in range(C)])
+    taus = np.arange(lambda_1,2*lambda_1)
+
+    # Split the columns into chunks handled by separate processes
+    chunks = np.array_split(np.arange(C),max(min(workers,C),1))
+    dig_chunks = [TField_dig[:,c] for c in chunks]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            sums = list(pool.map(moment_sums,dig_chunks,repeat(taus),
+                                 repeat(num_bins)))
+    else:
+        sums = list(map(moment_sums,dig_chunks,repeat(taus),repeat(num_bins)))
+    counts, S1, S2 = [np.concatenate(s,axis=0) for s in zip(*sums)]
+    dx = dx[:,np.newaxis,np.newaxis]
+    if pooled:
+        if len(bins) > 1:
+            # Bins differ between the columns, add the increments up in
+            # physical units
+            S1, S2, dx = dx*S1, dx*dx*S2, np.ones((1,1,1))
+        counts, S1, S2 = [np.sum(s,axis=0,keepdims=True)
+                          for s in (counts,S1,S2)]
+    M1 = np.divide(dx*S1,counts,out=np.zeros(S1.shape),where=counts>0)
+    M2 = np.divide(dx*dx*S2,counts,out=np.zeros(S2.shape),where=counts>0)
+    D1, D2 = KM_coefficients(M1,M2,taus,dt)
+
+    # Extract from calculated tau values to zero
+    Tau = np.linspace(lambda_1,2*lambda_1,len(taus))
+    weights = counts if weighted else None
+    D1_e = zero_lag_extrapolation(Tau,D1,weights,mask=D2!=0)
+    D2_e = zero_lag_extrapolation(Tau,D2,weights)
+    if pooled:
+        return bins[0],D1_e[0],D2_e[0]
     return bins,D1_e,D2_e
 
+class KMAccumulator:
+    """
+    Streaming Kramers-Moyal estimator. Transition counts and increment sums
+    are accumulated per time shift and bin as data arrives, so the whole
+    time series never has to be held in memory. Accumulators built from
+    separate shards can be combined with merge.
+
+    Parameters
+    ----------
+    bin_lims : TYPE, numpy array with len = 2
+        Upper and lower bound for bins. These must be known up front.
+    lambda_1 : TYPE, integer
+        Markov property number of time steps.
+    dt : TYPE, float
+        Time step size.
+    num_bins : TYPE, integer
+        Number of bins to bin the data by. The default is 200.
+    columns : TYPE, integer
+        Number of spatial points in each snapshot, whose time series are
+        pooled. The default is None, for a single scalar time series.
+
+    """
+
+    def __init__(self, bin_lims, lambda_1, dt, num_bins = 200, columns = None):
+        self.bins = np.linspace(bin_lims[0],bin_lims[1],num_bins)
+        self.dx = np.mean(np.diff(self.bins))
+        self.lambda_1 = lambda_1
+        self.dt = dt
+        self.taus = np.arange(lambda_1,2*lambda_1)
+        self.columns = columns
+        self.length = 0
+        self.counts = np.zeros((len(self.taus),num_bins),dtype=np.int64)
+        self.S1 = np.zeros((len(self.taus),num_bins))
+        self.S2 = np.zeros((len(self.taus),num_bins))
+
+        # First and last samples, needed for transitions across boundaries
+        width = 1 if columns is None else columns
+        self.head = np.zeros((0,width),dtype=np.int64)
+        self.tail = np.zeros((0,width),dtype=np.int64)
+
+    # add the transitions of digitized data, skipping the first `start` rows
+    def _accumulate(self, ts_dig, start, stop=None):
+        counts, S1, S2 = moment_sums(ts_dig,self.taus,len(self.bins),
+                                     dest_start=start,src_stop=stop)
+        self.counts += np.sum(counts,axis=0)
+        self.S1 += np.sum(S1,axis=0)
+        self.S2 += np.sum(S2,axis=0)
+
+    def update(self, data):
+        """
+        Add the next chunk of the time series.
+
+        Parameters
+        ----------
+        data : TYPE, numpy array
+            Next samples in time. A 1D array of time samples for a scalar
+            series, or a single snapshot (columns) or block of snapshots
+            (time x columns) when columns is set.
+
+        Returns
+        -------
+        self : TYPE, KMAccumulator
+
+        """
+        width = np.shape(self.tail)[1]
+        ts_dig = np.digitize(np.reshape(np.asarray(data),(-1,width)),self.bins)
+        self._accumulate(np.concatenate([self.tail,ts_dig]),len(self.tail))
+        keep = self.taus[-1]
+        if len(self.head) < keep:
+            self.head = np.concatenate([self.head,ts_dig])[:keep]
+        self.tail = np.concatenate([self.tail,ts_dig])[-keep:]
+        self.length += len(ts_dig)
+        return self
+
+    def merge(self, other, contiguous = False):
+        """
+        Add the transitions accumulated by another estimator.
+
+        Parameters
+        ----------
+        other : TYPE, KMAccumulator
+            Estimator with the same bins, Markov scale and columns.
+        contiguous : TYPE, boolean
+            The data of other directly follows the data of self in time, so
+            transitions across the boundary are also counted. The default is
+            False, treating the shards as independent series.
+
+        Returns
+        -------
+        self : TYPE, KMAccumulator
+
+        """
+        if (not np.array_equal(self.bins,other.bins)
+                or not np.array_equal(self.taus,other.taus)
+                or self.columns != other.columns or self.dt != other.dt):
+            raise ValueError("Only estimators with the same bins, lambda_1, "
+                             "dt and columns can be merged")
+        self.counts += other.counts
+        self.S1 += other.S1
+        self.S2 += other.S2
+        if contiguous:
+            joint = np.concatenate([self.tail,other.head])
+            self._accumulate(joint,len(self.tail),len(self.tail))
+            keep = self.taus[-1]
+            if len(self.head) < keep:
+                self.head = np.concatenate([self.head,other.head])[:keep]
+            self.tail = np.concatenate([self.tail,other.tail])[-keep:]
+            self.length += other.length
+        return self
+
+    def finalize(self, weighted = False):
+        """
+        Calculate the KM coefficients from the accumulated data.
+
+        Parameters
+        ----------
+        weighted : TYPE, boolean
+            Weight the extrapolation to zero by the number of transitions
+            behind each value. The default is False.
+
+        Returns
+        -------
+        bins : TYPE, 1xnum_bins numpy array
+            Bins or x values for KM coefficients.
+        D1_e : TYPE, 1xnum_bins numpy array
+            D1 coefficients extrapolated to zero.
+        D2_e : TYPE, 1xnum_bins numpy array
+            D2 coefficients extrapoalted to zero.
+
+        """
+        dx = self.dx
+        M1 = np.divide(dx*self.S1,self.counts,out=np.zeros(self.S1.shape),
+                       where=self.counts>0)
+        M2 = np.divide(dx*dx*self.S2,self.counts,out=np.zeros(self.S2.shape),
+                       where=self.counts>0)
+        D1, D2 = KM_coefficients(M1,M2,self.taus,self.dt)
+
+        # Extract from calculated tau values to zero
+        Tau = np.linspace(self.lambda_1,2*self.lambda_1,len(self.taus))
+        weights = self.counts if weighted else None
+        D1_e = zero_lag_extrapolation(Tau,D1,weights,mask=D2!=0)
+        D2_e = zero_lag_extrapolation(Tau,D2,weights)
+        return self.bins,D1_e,D2_e
+
 def find_KM_fit_coeffs(bins,D1,D2,D1_order=1,D2_order=2):
     """
     Find the polynomial fit used to generate the KM coefficients.
@@ -235,6 +948,244 @@ def find_KM_fit_coeffs(bins,D1,D2,D1_order=1,D2_order=2):
     D2_coeffs = np.polyfit(bins[idx2],D2[idx2],D2_order)
     return D1_coeffs, D2_coeffs
 
+def KM_table(bins,D1,D2,num=1024,smooth=5):
+    """
+    Tabulate binned KM coefficients on a uniform grid for fast lookup, in
+    place of a polynomial fit.
+
+    Parameters
+    ----------
+    bins : TYPE numpy array
+        Center of the bins from KM coefficient calculation.
+    D1 : TYPE, numpy array
+        First-order KM values corresponding to the bins.
+    D2 : TYPE, numpy array
+        Second-order KM values corresponding to the bins.
+    num : TYPE, integer
+        Number of table entries. The default is 1024.
+    smooth : TYPE, integer
+        Width in bins of the moving average applied before tabulating, 1 for
+        no smoothing. The default is 5.
+
+    Returns
+    -------
+    x0 : TYPE, float
+        Value at the first table entry.
+    dx : TYPE, float
+        Spacing of the table entries.
+    table : TYPE, numpy array
+        D1 (first row) and D2 (second row) at the table entries. The table
+        spans the bins where both have data and D2 is clamped to be
+        non-negative.
+
+    """
+    valid = (D1!=0) & (D2!=0) & np.isfinite(D1) & np.isfinite(D2)
+    grid = np.linspace(bins[valid][0],bins[valid][-1],num)
+    table = np.empty((2,num))
+    for row, D in enumerate((D1,D2)):
+        # fill empty bins, then smooth with the edges extended
+        idx = (D!=0) & np.isfinite(D)
+        filled = np.interp(bins,bins[idx],D[idx])
+        if smooth > 1:
+            padded = np.pad(filled,(smooth//2,smooth-1-smooth//2),mode='edge')
+            filled = np.convolve(padded,np.ones(smooth)/smooth,mode='valid')
+        table[row] = np.interp(grid,bins,filled)
+    table[1] = np.maximum(table[1],0)
+    return grid[0], grid[1]-grid[0], table
+
+class KMCache:
+    """
+    On-disk cache for trained KM closures. Entries are keyed on a hash of
+    the training series and every training parameter, and the least
+    recently used entries are removed once the cache exceeds max_size.
+
+    Parameters
+    ----------
+    path : TYPE, string
+        Directory holding the cache entries. The default is '.km_cache'.
+    max_size : TYPE, integer
+        Maximum total size of the cache in bytes. The default is 100 MB.
+
+    """
+
+    def __init__(self, path = '.km_cache', max_size = 100*2**20):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path,exist_ok=True)
+
+    def key(self, TSeries, **params):
+        """
+        Hash a training series and its parameters into a cache key.
+
+        Parameters
+        ----------
+        TSeries : TYPE, numpy array
+            Time series used for training.
+        **params : TYPE, JSON serializable values
+            Every parameter that changes the trained result.
+
+        Returns
+        -------
+        TYPE, string
+            Hexadecimal key.
+
+        """
+        data = np.ascontiguousarray(TSeries)
+        h = hashlib.sha256()
+        h.update(str((data.dtype.str,data.shape)).encode())
+        h.update(data.tobytes())
+        h.update(json.dumps(params,sort_keys=True,default=str).encode())
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path,key+'.npz')
+
+    def get(self, key):
+        """
+        Load a cache entry.
+
+        Returns
+        -------
+        TYPE, dictionary of numpy arrays or None
+            Stored arrays, or None if the key is not cached.
+
+        """
+        fname = self._file(key)
+        try:
+            with np.load(fname) as data:
+                entry = {k: data[k] for k in data.files}
+        except (OSError, ValueError):
+            return None
+
+        # mark as recently used (another process may have evicted it)
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, **arrays):
+        """
+        Store arrays under a key and evict old entries if needed.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.path,suffix='.tmp')
+        with os.fdopen(fd,'wb') as f:
+            np.savez(f,**arrays)
+        os.replace(tmp,self._file(key))
+        self.evict(keep=key)
+
+    def evict(self, keep = None):
+        """
+        Remove least recently used entries until the cache fits max_size.
+        """
+        entries = []
+        for fname in os.listdir(self.path):
+            if fname.endswith('.npz'):
+                try:
+                    st = os.stat(os.path.join(self.path,fname))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime,st.st_size,fname))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        for mtime,size,fname in entries:
+            if total <= self.max_size:
+                break
+            if fname == str(keep)+'.npz':
+                continue
+            try:
+                os.remove(os.path.join(self.path,fname))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def invalidate(self, key):
+        """
+        Remove a single entry from the cache.
+        """
+        if os.path.exists(self._file(key)):
+            os.remove(self._file(key))
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        for fname in os.listdir(self.path):
+            if fname.endswith('.npz'):
+                os.remove(os.path.join(self.path,fname))
+
+def train_KM(TSeries, dt, lambda_1 = False, num_bins = 200, bin_lims = False,
+             lam_bins = 10, numPeriods = 10, maxOffset = 50, D1_order = 1,
+             D2_order = 2, cache = None):
+    """
+    Find the Markov scale, KM coefficients and their polynomial fits for a
+    time series, reusing a cached result when available.
+
+    Parameters
+    ----------
+    TSeries : TYPE, numpy array
+        Time series to train on.
+    dt : TYPE, float
+        Time step size.
+    lambda_1 : TYPE, integer
+        Markov property number of time steps. The default is False, which
+        finds it with findLambda.
+    num_bins : TYPE, integer
+        Number of bins to bin the data by. The default is 200.
+    bin_lims : TYPE, numpy array with len = 2
+        Upper and lower bound for bins. The default is False.
+    lam_bins : TYPE, integer
+        Number of bins used by findLambda. The default is 10.
+    numPeriods : TYPE, integer
+        Number of sections used by findLambda. The default is 10.
+    maxOffset : TYPE, integer
+        Maximum offset searched by findLambda. The default is 50.
+    D1_order : TYPE, integer
+        Order for fitting function for D1. The default is 1.
+    D2_order : TYPE, integer
+        Order for fitting function for D2. The default is 2.
+    cache : TYPE, KMCache
+        Cache for the results. The default is None (no caching).
+
+    Returns
+    -------
+    result : TYPE, dictionary
+        'lambda_1', 'bins', 'D1_e', 'D2_e', 'D1_coeffs' and 'D2_coeffs'.
+
+    """
+    if bin_lims is not False:
+        bin_lims = [float(b) for b in bin_lims]
+    if cache is not None:
+        key = cache.key(TSeries,dt=dt,lambda_1=lambda_1,num_bins=num_bins,
+                        bin_lims=bin_lims,lam_bins=lam_bins,
+                        numPeriods=numPeriods,maxOffset=maxOffset,
+                        D1_order=D1_order,D2_order=D2_order,
+                        revision=KM_REVISION)
+        entry = cache.get(key)
+        if entry is not None:
+            entry['lambda_1'] = int(entry['lambda_1'])
+            return entry
+
+    if lambda_1 is False:
+        lambda_1 = findLambda(TSeries,lam_bins=lam_bins,numPeriods=numPeriods,
+                              maxOffset=maxOffset)
+    bins, D1_e, D2_e = KM(TSeries,lambda_1,dt,num_bins=num_bins,
+                          bin_lims=bin_lims)
+    D1_coeffs, D2_coeffs = find_KM_fit_coeffs(bins,D1_e,D2_e,
+                                              D1_order=D1_order,
+                                              D2_order=D2_order)
+    result = {
+        'lambda_1'  :   int(lambda_1),
+        'bins'      :   bins,
+        'D1_e'      :   D1_e,
+        'D2_e'      :   D2_e,
+        'D1_coeffs' :   D1_coeffs,
+        'D2_coeffs' :   D2_coeffs
+    }
+    if cache is not None:
+        cache.put(key,**result)
+    return result
+
 def regenerate_ts(x_0,D1_coeffs,D2_coeffs,N=2000,dt=0.1):
     """
     Regenerate a time series from KM coefficients
@@ -260,16 +1211,88 @@ def regenerate_ts(x_0,D1_coeffs,D2_coeffs,N=2000,dt=0.1):
 
     """
     X_i = x_0
-    X = []
+    X = np.zeros(N)
+    noise = np.random.normal(loc=0,scale=1.0,size=N)
     for i in range(N):
         LocalDrift = X_i*D1_coeffs[0]+D1_coeffs[1]
         LocalDiffusion = X_i**2*D2_coeffs[0]+X_i*D2_coeffs[1]+D2_coeffs[2]
         if(LocalDiffusion<0):
             LocalDiffusion = np.abs(LocalDiffusion)
-        X_i=X_i+(LocalDrift)*dt+np.sqrt(2.0*LocalDiffusion*dt)*np.random.normal(loc=0,scale=1.0)
-        #LocalDiffusions.append(LocalDiffusion)
-        #LocalDrifts.append(LocalDrift)
-        X = np.append(X,X_i)
-    X = np.asarray(X)
+        X_i=X_i+(LocalDrift)*dt+np.sqrt(2.0*LocalDiffusion*dt)*noise[i]
+        X[i] = X_i
+    return X
+
+def regenerate_chunks(x_0,D1_coeffs,D2_coeffs,N=2000,dt=0.1,M=1,rng=None,
+                      chunk=None,budget=2**24):
+    """
+    Regenerate an ensemble of independent time series from KM coefficients,
+    yielding the result in blocks of time steps.
+
+    Parameters
+    ----------
+    x_0 : TYPE, float or numpy array with len = M.
+        Initial value of every realization.
+    D1_coeffs : TYPE, numpy array
+        Polynomial coefficients for D1, highest order first (any order).
+    D2_coeffs : TYPE, numpy array
+        Polynomial coefficients for D2, highest order first (any order).
+    N : TYPE, integer
+        How many time steps to solve for. The default is 2000.
+    dt : TYPE, float
+        Time step size. The default is 0.1.
+    M : TYPE, integer
+        Number of realizations. The default is 1.
+    rng : TYPE, numpy.random.Generator or integer
+        Random number generator or seed. The default is None.
+    chunk : TYPE, integer
+        Number of time steps per block. The default is None, which sizes the
+        blocks so that their noise and values fit into budget bytes.
+    budget : TYPE, integer
+        Memory budget in bytes of a block when chunk is None. The default is
+        2**24.
+
+    Yields
+    ------
+    X : TYPE, Mxchunk numpy array
+        Next block of the regenerated time series (the last block may be
+        shorter).
+
+    """
+    rng = np.random.default_rng(rng)
+    X_i = np.array(np.broadcast_to(x_0,(M,)),dtype=float)
+    if chunk is None:
+        chunk = max(budget//(16*M),1)
+    for start in range(0,N,chunk):
+        n = min(chunk,N-start)
+        noise = rng.standard_normal((n,M))
+        X = np.empty((n,M))
+        for i in range(n):
+            LocalDrift = np.zeros(M)
+            for c in D1_coeffs:
+                LocalDrift = LocalDrift*X_i+c
+            LocalDiffusion = np.zeros(M)
+            for c in D2_coeffs:
+                LocalDiffusion = LocalDiffusion*X_i+c
+            X_i = X_i+LocalDrift*dt+np.sqrt(2.0*np.abs(LocalDiffusion)*dt)*noise[i]
+            X[i] = X_i
+        yield X.T
+
+def regenerate_ensemble(x_0,D1_coeffs,D2_coeffs,N=2000,dt=0.1,M=1,rng=None,
+                        chunk=None,budget=2**24):
+    """
+    Regenerate an ensemble of independent time series from KM coefficients.
+    See regenerate_chunks for the parameters.
+
+    Returns
+    -------
+    X : TYPE, MxN numpy array
+        Regenerated time series, one realization per row.
+
+    """
+    X = np.empty((M,N))
+    start = 0
+    for block in regenerate_chunks(x_0,D1_coeffs,D2_coeffs,N=N,dt=dt,M=M,
+                                   rng=rng,chunk=chunk,budget=budget):
+        X[:,start:start+np.shape(block)[1]] = block
+        start += np.shape(block)[1]
     return X
-    
@@ -0,0 +1,462 @@
+#/usr/bin/env python
+# Benchmarks for the KM training and Burgers solver hot paths
+#
+# usage: python benchmark.py run [results.json] [--quick] [--reference DIR]
+#        python benchmark.py compare baseline.json results.json [--tolerance 0.1]
+#
+# "run" times the KM training functions over several series lengths, the
+# spectral helpers and subgrid models over several grid sizes, and the steps
+# per second of the DNS and LES loops. Every fast path is also checked
+# against the slower path it replaces (dense and sparse transition matrices,
+# the matrix and direct KM methods, serial and threaded findLambda, ...).
+# With --reference, KM_utils.py and burgers.py from another directory (e.g.
+# an older checkout made with "git worktree add") are timed on the same
+# inputs and their results compared. Results are written as JSON.
+#
+# "compare" prints the ratio of every timing to the baseline and exits with
+# status 1 when a timing got slower by more than the tolerance or an
+# agreement check failed.
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import tempfile
+import importlib.util
+import numpy as np
+import scipy
+from scipy.signal import lfilter
+import KM_utils as km
+from burgers import (Utils, FBMNoise, SpectralOperator, Settings, BurgersLES,
+                     sgs_model)
+import burgersDNS
+import burgers_LESKMfromDNS as les
+
+# sizes for the full and quick runs
+SIZES = {
+    'full'  : {'lengths': [10**4, 10**5], 'nx': [512, 8192],
+               'steps': [3000, 10000], 'repeat': 5},
+    'quick' : {'lengths': [10**4], 'nx': [512],
+               'steps': [3000], 'repeat': 3},
+}
+
+# namelist for the solver benchmarks, nx and nt are set per run
+NAMELIST = {
+    "nt"    : 3000,
+    "dt"    : 1E-4,
+    "visc"  : 1E-5,
+    "damp"  : 1E-6,
+    "dns"   : {"nx": 8192},
+    "les"   : {"nx": 512, "sgs": 1}
+}
+
+# LES grid of burgers_LESKMfromDNS
+nxLES = 512
+
+# KM coefficients of a stable test closure
+D1_COEFFS = np.array([-1.0, 0.0])
+D2_COEFFS = np.array([0.1, 0.0, 0.5])
+
+# class to collect timings and agreement checks
+class Results:
+
+    def __init__(self,repeat,quick=False):
+        self.repeat    = repeat
+        self.timings   = {}
+        self.agreement = {}
+        self.meta = {
+            'date'     : time.ctime(time.time()),
+            'python'   : platform.python_version(),
+            'numpy'    : np.__version__,
+            'scipy'    : scipy.__version__,
+            'platform' : platform.platform(),
+            'cpus'     : os.cpu_count(),
+            'quick'    : quick,
+        }
+
+    # function to time fn, called often enough for every repeat to take at
+    # least 0.2 seconds, keeping the best and median time per call
+    def time(self,name,fn,**extra):
+        timer     = timeit.Timer(fn)
+        number, _ = timer.autorange()
+        times     = np.array(timer.repeat(self.repeat,number))/number
+        entry = {
+            'seconds' : float(times.min()),
+            'median'  : float(np.median(times)),
+            'number'  : number,
+            'repeat'  : self.repeat,
+        }
+        entry.update(extra)
+        self.timings[name] = entry
+        print("[pyBurgers: Benchmark] \t %-48s %12.3e s"%(name,entry['seconds']))
+
+    # function to record the largest difference between two results
+    def agree(self,name,a,b,rtol=1e-10,atol=0.0):
+        xs, ys = flatten(a), flatten(b)
+        if len(xs) != len(ys) or any(x.shape != y.shape for x,y in zip(xs,ys)):
+            diff, scale, ok = float('inf'), 0.0, False
+        else:
+            diff  = max((float(np.max(np.abs(x-y),initial=0)) for x,y in zip(xs,ys)),default=0.0)
+            scale = max((float(np.max(np.abs(x),initial=0)) for x in xs),default=0.0)
+            ok    = bool(diff <= atol+rtol*scale)
+        self.agreement[name] = {
+            'max_abs_diff' : diff,
+            'scale'        : scale,
+            'rtol'         : rtol,
+            'atol'         : atol,
+            'ok'           : ok,
+        }
+        print("[pyBurgers: Benchmark] \t %-48s %12.3e %s"%(name,diff,"ok" if ok else "FAILED"))
+
+    def save(self,fname):
+        with open(fname,'w') as f:
+            json.dump({'meta': self.meta, 'timings': self.timings,
+                       'agreement': self.agreement},f,indent=4)
+
+# function to turn a result (array, sparse matrix, scalar, dictionary or
+# sequence of these) into a list of float arrays
+def flatten(x):
+    if isinstance(x,dict):
+        return [a for k in sorted(x) for a in flatten(x[k])]
+    if isinstance(x,(tuple,list)):
+        return [a for item in x for a in flatten(item)]
+    if hasattr(x,'toarray'):
+        x = x.toarray()
+    return [np.asarray(x,dtype=float)]
+
+# function to describe an error on one line
+def describe(err):
+    lines = str(err).splitlines()
+    return "%s: %s"%(type(err).__name__,lines[0] if lines else "")
+
+# function to load KM_utils.py and burgers.py from a reference directory,
+# skipping modules that do not import
+def load_reference(path):
+    modules = {}
+    for name in ('KM_utils','burgers'):
+        fname = os.path.join(path,name+'.py')
+        spec  = importlib.util.spec_from_file_location('reference_'+name,fname)
+        try:
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except Exception as err:
+            print("[pyBurgers: Benchmark] \t Skipping reference %s (%s)"%(fname,describe(err)))
+            continue
+        modules[name] = module
+    return modules
+
+# function to build a correlated test series like tau at one point
+def test_series(n,seed=0):
+    rng = np.random.default_rng(seed)
+    return lfilter([1.0],[1.0,-0.95],rng.standard_normal(n))
+
+# function to write a namelist with the given changes and read it back
+def test_settings(workdir,**changes):
+    namelist = json.loads(json.dumps(NAMELIST))
+    for key,value in changes.items():
+        if key in ('nxDNS','sgs'):
+            section, name = {'nxDNS': ('dns','nx'), 'sgs': ('les','sgs')}[key]
+            namelist[section][name] = value
+        else:
+            namelist[key] = value
+    fname = os.path.join(workdir,'namelist.json')
+    with open(fname,'w') as f:
+        json.dump(namelist,f,indent=4)
+    return fname
+
+# function to time a call on the reference module and check its result
+# against the current one, when the reference has the function
+def compare_reference(results,ref,name,fn,current,seed=None,**agree):
+    if ref is None:
+        return
+    if seed is not None:
+        np.random.seed(seed)
+    try:
+        value = fn(ref)
+    except Exception as err:
+        print("[pyBurgers: Benchmark] \t Skipping reference %s (%s)"%(name,describe(err)))
+        return
+    results.agree('reference/'+name,current,value,**agree)
+    results.time('reference/'+name,lambda: fn(ref))
+
+# KM training benchmarks
+def bench_km(results,lengths,ref=None):
+    for n in lengths:
+        x      = test_series(n)
+        bins   = np.linspace(np.min(x),np.max(x))
+        ts_dig = np.digitize(x,bins)
+        lam    = 10
+        tag    = "[N=%d]"%n
+
+        # transition matrices
+        P = km.transition_matrix(ts_dig,20)
+        results.time('transition_matrix'+tag,lambda: km.transition_matrix(ts_dig,20))
+        results.time('transition_matrix_sparse'+tag,
+                     lambda: km.transition_matrix(ts_dig,20,sparse=True))
+        results.agree('transition_matrix_sparse'+tag,P,
+                      km.transition_matrix(ts_dig,20,sparse=True))
+        compare_reference(results,ref,'transition_matrix'+tag,
+                          lambda m: m.transition_matrix(ts_dig,20),P)
+
+        # chi-square statistic and Markov time scale
+        Q = km.findQ(x)
+        results.time('findQ'+tag,lambda: km.findQ(x))
+        results.agree('findQ_sparse'+tag,Q,km.findQ(x,sparse=True))
+        compare_reference(results,ref,'findQ'+tag,lambda m: m.findQ(x),Q)
+
+        L = km.findLambda(x)
+        results.time('findLambda'+tag,lambda: km.findLambda(x))
+        results.agree('findLambda_threads'+tag,L,
+                      km.findLambda(x,workers=2,executor='thread'),rtol=0)
+        results.agree('findLambda_sparse'+tag,L,km.findLambda(x,sparse=True),
+                      rtol=0)
+        compare_reference(results,ref,'findLambda'+tag,
+                          lambda m: m.findLambda(x),L,rtol=0)
+
+        # KM coefficients
+        K = km.KM(x,lam,0.1)
+        results.time('KM'+tag,lambda: km.KM(x,lam,0.1))
+        results.time('KM_direct'+tag,lambda: km.KM(x,lam,0.1,method='direct'))
+        results.agree('KM_direct'+tag,K,km.KM(x,lam,0.1,method='direct'))
+        bin_lims = [np.min(x)+np.std(x),np.max(x)-np.std(x)]
+        acc = km.KMAccumulator(bin_lims,lam,0.1)
+        for block in np.array_split(x,7):
+            acc.update(block)
+        results.agree('KMAccumulator'+tag,K,acc.finalize())
+        compare_reference(results,ref,'KM'+tag,lambda m: m.KM(x,lam,0.1),K)
+
+        # regenerated series
+        np.random.seed(1)
+        X = km.regenerate_ts(0.0,D1_COEFFS,D2_COEFFS,N=n)
+        results.time('regenerate_ts'+tag,
+                     lambda: km.regenerate_ts(0.0,D1_COEFFS,D2_COEFFS,N=n))
+        results.time('regenerate_ensemble'+tag+'[M=64]',
+                     lambda: km.regenerate_ensemble(0.0,D1_COEFFS,D2_COEFFS,
+                                                    N=n,M=64,rng=1),members=64)
+        compare_reference(results,ref,'regenerate_ts'+tag,
+                          lambda m: m.regenerate_ts(0.0,D1_COEFFS,D2_COEFFS,N=n),
+                          X,seed=1)
+
+# spectral helper and subgrid model benchmarks
+def bench_spectral(results,sizes,workdir,ref=None):
+    utils    = Utils()
+    settings = Settings(test_settings(workdir))
+    for nx in sizes:
+        dx   = 2*np.pi/nx
+        tag  = "[nx=%d]"%nx
+        np.random.seed(2)
+        u    = utils.noise(0.75,nx)
+
+        # derivatives
+        spectral = SpectralOperator(nx,dx)
+        derivs = utils.derivative(u,dx)
+        results.time('Utils.derivative'+tag,lambda: utils.derivative(u,dx))
+        results.time('SpectralOperator.derivative'+tag,lambda: spectral.derivative(u))
+        results.agree('SpectralOperator.derivative'+tag,derivs,
+                      spectral.derivative(u),rtol=1e-9)
+
+        # noise, per step as generated by Utils and amortized over a block
+        results.time('Utils.noise'+tag,lambda: utils.noise(0.75,nx))
+        fbm = FBMNoise(0.75,nx,seed=2)
+        results.time('FBMNoise.next'+tag,fbm.next)
+        np.random.seed(3)
+        steps = [utils.filterDown(utils.noise(0.75,nx),2) for i in range(8)]
+        np.random.seed(3)
+        fbm = FBMNoise(0.75,nx//2,nfine=nx,exact=True,block=8)
+        results.agree('FBMNoise_exact'+tag,steps,[fbm.next() for i in range(8)])
+
+        # filters and dealiasing
+        up = utils.dealias1(u,nx)
+        results.time('Utils.filterDown'+tag,lambda: utils.filterDown(u,2))
+        results.time('Utils.filterBox'+tag,lambda: utils.filterBox(u,2))
+        results.time('Utils.dealias1'+tag,lambda: utils.dealias1(u,nx))
+        results.time('Utils.dealias2'+tag,lambda: utils.dealias2(up,nx))
+
+        if ref is not None and 'burgers' in ref:
+            old = ref['burgers'].Utils()
+            calls = {
+                'Utils.derivative' : lambda m: old.derivative(u,dx),
+                'Utils.filterDown' : lambda m: old.filterDown(u,2),
+                'Utils.filterBox'  : lambda m: old.filterBox(u,2),
+                'Utils.dealias1'   : lambda m: old.dealias1(u,nx),
+                'Utils.dealias2'   : lambda m: old.dealias2(up,nx),
+            }
+            current = {
+                'Utils.derivative' : derivs,
+                'Utils.filterDown' : utils.filterDown(u,2),
+                'Utils.filterBox'  : utils.filterBox(u,2),
+                'Utils.dealias1'   : up,
+                'Utils.dealias2'   : utils.dealias2(up,nx),
+            }
+            for name in calls:
+                compare_reference(results,ref['burgers'],name+tag,calls[name],
+                                  current[name],rtol=1e-9)
+            np.random.seed(2)
+            compare_reference(results,ref['burgers'],'Utils.noise'+tag,
+                              lambda m: old.noise(0.75,nx),utils.noise(0.75,nx),
+                              seed=2,rtol=1e-9)
+
+        # subgrid models, Deardorff state is reset by subgrid on every call
+        dudx = derivs['dudx']
+        kr   = 0.01*u**2
+        for model in range(6):
+            sgs = BurgersLES(model,settings)
+            results.time('BurgersLES.subgrid[model=%d]'%model+tag,
+                         lambda: sgs.subgrid(u,dudx,dx,kr))
+
+        # KM closure with polynomial and tabulated drift and diffusion
+        eta  = np.random.normal(0,1,[1000,nx])
+        tau0 = 0.5*u/np.std(u)
+        xs   = np.linspace(-4,4,200)
+        table = km.KM_table(xs,np.polyval(D1_COEFFS,xs),np.polyval(D2_COEFFS,xs))
+        for name,kwargs in (('poly',{}),('table',{'table':table})):
+            closure = sgs_model(6,settings,nx,dx,d1_coeffs=D1_COEFFS,
+                                d2_coeffs=D2_COEFFS,eta=eta,**kwargs)
+            results.time('KMClosure.step[%s]'%name+tag,
+                         lambda: (closure.reset(tau0),closure.step(u,dudx)))
+        closure.reset(tau0)
+        results.agree('KMClosure.lookup'+tag,
+                      np.stack((np.polyval(D1_COEFFS,tau0),np.polyval(D2_COEFFS,tau0))),
+                      closure.lookup(tau0),rtol=1e-3)
+
+# stand-in for a SnapshotRing that records when the DNS writes an output
+class Stamps:
+
+    def __init__(self):
+        self.times = []
+
+    def put(self,u):
+        self.times.append(time.perf_counter())
+
+    # steps per second between the first and last output (every 1000 steps)
+    def rate(self):
+        if len(self.times) < 2:
+            return float('nan')
+        return 1000*(len(self.times)-1)/(self.times[-1]-self.times[0])
+
+# function to run a driver with its console output discarded
+def quiet(fn,*args,**kwargs):
+    sys.stdout.flush()
+    console = os.dup(1)
+    with open(os.devnull,'w') as devnull:
+        os.dup2(devnull.fileno(),1)
+        try:
+            return fn(*args,**kwargs)
+        finally:
+            sys.stdout.flush()
+            os.dup2(console,1)
+            os.close(console)
+
+# function to record the steps per second of a solver loop
+def record_rate(results,name,stamps,seconds,nt):
+    rate = stamps.rate()
+    results.timings[name] = {
+        'seconds'          : 1/rate,
+        'steps_per_second' : rate,
+        'total_seconds'    : seconds,
+        'steps'            : nt,
+    }
+    print("[pyBurgers: Benchmark] \t %-48s %12.1f steps/s"%(name,rate))
+
+# DNS and LES loop benchmarks, timed between outputs to leave out the setup
+# and the training of the KM closure
+def bench_solvers(results,sizes,steps,workdir):
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        # synthetic tau for the LES, one correlated series per point
+        rng     = np.random.default_rng(4)
+        tau_dns = lfilter([1.0],[1.0,-0.95],rng.standard_normal((4000,nxLES)),axis=0)
+        for nx in sizes:
+            for nt in steps:
+                tag      = "[nx=%d,nt=%d]"%(nx,nt)
+                namelist = test_settings(workdir,nxDNS=nx,nt=nt)
+
+                stamps = Stamps()
+                t1 = time.time()
+                quiet(burgersDNS.main,namelist,'dns.nc',ring=stamps)
+                record_rate(results,'DNS'+tag,stamps,time.time()-t1,nt)
+
+                stamps = Stamps()
+                refresh = lambda save_t,closure: stamps.put(None)
+                t1 = time.time()
+                quiet(les.main,namelist,'dns.nc','les.nc',tau_dns=tau_dns,
+                      refresh=refresh)
+                record_rate(results,'LES'+tag,stamps,time.time()-t1,nt)
+    finally:
+        os.chdir(cwd)
+
+# function to run the benchmarks
+def run(fname,quick=False,reference=None):
+    sizes   = SIZES['quick' if quick else 'full']
+    results = Results(sizes['repeat'],quick)
+    ref     = load_reference(reference) if reference else {}
+    if reference:
+        results.meta['reference'] = os.path.abspath(reference)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print("[pyBurgers: Benchmark] \t KM training")
+        bench_km(results,sizes['lengths'],ref.get('KM_utils'))
+        print("[pyBurgers: Benchmark] \t Spectral helpers and subgrid models")
+        bench_spectral(results,sizes['nx'],workdir,ref or None)
+        print("[pyBurgers: Benchmark] \t DNS and LES loops")
+        bench_solvers(results,sizes['nx'],sizes['steps'],workdir)
+
+    results.save(fname)
+    failed = [name for name,entry in results.agreement.items() if not entry['ok']]
+    print("[pyBurgers: Benchmark] \t Results in %s (%d agreement checks failed)"%(fname,len(failed)))
+    return 1 if failed else 0
+
+# function to compare results against a baseline
+def compare(baseline_fname,fname,tolerance=0.1):
+    with open(baseline_fname) as f:
+        baseline = json.load(f)
+    with open(fname) as f:
+        current = json.load(f)
+
+    slower = []
+    print("%-56s %12s %12s %8s"%("benchmark","baseline","current","ratio"))
+    for name in sorted(set(baseline['timings'])&set(current['timings'])):
+        old   = baseline['timings'][name]['seconds']
+        new   = current['timings'][name]['seconds']
+        ratio = new/old if old > 0 else float('inf')
+        flag  = ""
+        if ratio > 1+tolerance:
+            flag = "SLOWER"
+            slower.append(name)
+        elif ratio < 1/(1+tolerance):
+            flag = "faster"
+        print("%-56s %12.3e %12.3e %8.2f %s"%(name,old,new,ratio,flag))
+
+    missing = sorted(set(baseline['timings'])-set(current['timings']))
+    for name in missing:
+        print("%-56s missing from %s"%(name,fname))
+    failed = sorted(name for name,entry in current['agreement'].items()
+                    if not entry['ok'])
+    for name in failed:
+        print("%-56s agreement FAILED (max abs diff %.3e)"%(
+            name,current['agreement'][name]['max_abs_diff']))
+
+    print("%d slower than %.0f%%, %d agreement checks failed"%(
+        len(slower),100*tolerance,len(failed)))
+    return 1 if slower or failed else 0
+
+if __name__ == "__main__":
+    parser  = argparse.ArgumentParser(description="pyBurgers benchmarks")
+    command = parser.add_subparsers(dest='command',required=True)
+    p = command.add_parser('run',help="run the benchmarks")
+    p.add_argument('output',nargs='?',default='benchmark.json')
+    p.add_argument('--quick',action='store_true',help="smaller sizes only")
+    p.add_argument('--reference',help="directory with reference KM_utils.py and burgers.py")
+    p = command.add_parser('compare',help="compare results to a baseline")
+    p.add_argument('baseline')
+    p.add_argument('results')
+    p.add_argument('--tolerance',type=float,default=0.1,
+                   help="allowed slowdown as a fraction (default 0.1)")
+    args = parser.parse_args()
+    if args.command == 'run':
+        sys.exit(run(args.output,args.quick,args.reference))
+    else:
+        sys.exit(compare(args.baseline,args.results,args.tolerance))
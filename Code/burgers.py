@@ -3,7 +3,14 @@
 
 # Functions for numerical solution of Burgers equation using DNS and LES
 
+import os
 import json
+import queue
+import pickle
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 import cmath as cm
 import netCDF4 as nc
@@ -13,24 +20,27 @@ from scipy.stats import norm
 class Utils:
 
     # function to generate fractional Brownian motion (FBM) noise
-    def noise(self,alpha,n):
-        x     = np.sqrt(n)*norm.ppf(np.random.rand(n))
+    # (nt time steps are drawn at once as rows when given)
+    def noise(self,alpha,n,nt=None):
+        size  = n if nt is None else (nt,n)
+        x     = np.sqrt(n)*norm.ppf(np.random.rand(*np.atleast_1d(size)))
         m     = int(n/2)
         k     = np.abs(np.fft.fftfreq(n,d=1/n))
         k[0]  = 1
         fx    = np.fft.fft(x)
-        fx[0] = 0
-        fx[m] = 0
+        fx[...,0] = 0
+        fx[...,m] = 0
         fx1   = fx * ( k**(-alpha/2) )
         x1    = np.real(np.fft.ifft(fx1))
         
         return x1
     
     # function to compute spatial derivatives in spectral space
+    # (fields may be stacked, derivatives are taken along the last axis)
     def derivative(self,u,dx):
         
         # signal shape information
-        n = int(u.shape[0])
+        n = int(u.shape[-1])
         m = int(n/2)
         
         # Fourier colocation method
@@ -44,13 +54,12 @@ class Utils:
         d3udx3  = fac**3 * np.real(np.fft.ifft(-cm.sqrt(-1)*k**3*fu))
         
         # dealiasing needed for du2dx using zero-padding 
-        zeroPad = np.zeros(n)
-        fu_p    = np.insert(fu,m,zeroPad)
+        zeroPad = np.zeros(u.shape[:-1]+(n,))
+        fu_p    = np.concatenate((fu[...,0:m],zeroPad,fu[...,m:]),axis=-1)
         u_p     = np.real(np.fft.ifft(fu_p))        
         u2_p    = u_p**2
         fu2_p   = np.fft.fft(u2_p)
-        fu2     = fu2_p[0:m]
-        fu2     = np.append(fu2,fu2_p[n+m:])
+        fu2     = np.concatenate((fu2_p[...,0:m],fu2_p[...,n+m:]),axis=-1)
         du2dx   = 2*fac*np.real(np.fft.ifft(cm.sqrt(-1)*k*fu2))
 
         # store derivatives in a dictionary for selective access
@@ -67,15 +76,15 @@ class Utils:
     def filterDown(self,u,k):
         
         # signal shape information
-        n   = int(u.shape[0])
+        n   = int(u.shape[-1])
         m   = int(n/k)
         l   = int(m/2)
         
         # compute fft then filter
         fu  = np.fft.fft(u)
-        fuf = np.zeros(m,dtype=np.complex)
-        fuf[0:l]   = fu[0:l]
-        fuf[l+1:m] = fu[n-l+1:n]
+        fuf = np.zeros(u.shape[:-1]+(m,),dtype=complex)
+        fuf[...,0:l]   = fu[...,0:l]
+        fuf[...,l+1:m] = fu[...,n-l+1:n]
         
         # return from spectral space
         uf = (1/k)*np.real(np.fft.ifft(fuf))
@@ -86,15 +95,15 @@ class Utils:
     def filterBox(self,u,k):
         
         # signal size information
-        n   = int(u.shape[0])
+        n   = int(u.shape[-1])
         m   = int(n/k)
         l   = int(m/2)
         
         # compute fft then filter
         fu  = np.fft.fft(u)
-        fuf = np.zeros(n,dtype=np.complex)
-        fuf[0:l]     = fu[0:l]
-        fuf[n-l+1:n] = fu[n-l+1:n]
+        fuf = np.zeros(u.shape,dtype=complex)
+        fuf[...,0:l]     = fu[...,0:l]
+        fuf[...,n-l+1:n] = fu[...,n-l+1:n]
 
         # return from spectral space
         uf = np.real(np.fft.ifft(fuf))
@@ -109,7 +118,8 @@ class Utils:
         
         # compute fft then de-alias
         fx  = np.fft.fft(x)
-        fxp = np.concatenate((fx[0:m+1],np.zeros(m),fx[m+1:n]))
+        pad = np.zeros(x.shape[:-1]+(m,))
+        fxp = np.concatenate((fx[...,0:m+1],pad,fx[...,m+1:n]),axis=-1)
         
         # return from spectral space
         xp  = np.real(np.fft.ifft(fxp))
@@ -124,14 +134,615 @@ class Utils:
         
         # compute fft then de-alias
         fxp   = np.fft.fft(xp)
-        fx    = np.concatenate((fxp[0:m+1],fxp[2*m+1:m+n]))
-        fx[m] = 0
+        fx    = np.concatenate((fxp[...,0:m+1],fxp[...,2*m+1:m+n]),axis=-1)
+        fx[...,m] = 0
         
         # return from spectral space
         x     = (3/2)*np.real(np.fft.ifft(fx))
         
         return x
 
+# class to generate fractional Brownian motion (FBM) noise in blocks
+class FBMNoise:
+
+    # initializer for noise with exponent alpha on n points, equivalent to
+    # filtering down noise generated on nfine points; with members set,
+    # every time step holds independent noise for each ensemble member;
+    # without a block size, as many time steps are generated at once as
+    # fit their random draws into budget bytes
+    def __init__(self,alpha,n,nfine=None,seed=None,block=None,exact=False,
+                 members=None,budget=2**24):
+        self.alpha = alpha
+        self.n     = int(n)
+        self.nfine = self.n if nfine is None else int(nfine)
+        if block is None:
+            width = (self.nfine if exact else self.n)*(members or 1)
+            block = min(max(budget//(8*width),1),1000)
+        self.block = int(block)
+        self.exact = exact
+        self.members = members
+        self.buffer = None
+        self.index  = 0
+        
+        if self.exact:
+            # same draws from the global generator as Utils.noise
+            self.utils = Utils()
+        else:
+            # shaped spectrum built directly at the target resolution; the
+            # mean and both Nyquist modes carry no energy
+            if members is None:
+                self.rng = np.random.default_rng(seed)
+            else:
+                seeds     = np.random.SeedSequence(seed).spawn(members)
+                self.rngs = [np.random.default_rng(s) for s in seeds]
+            m        = int(self.n/2)
+            k        = np.arange(m+1)
+            self.amp = np.zeros(m+1)
+            self.amp[1:m] = k[1:m]**(-alpha/2)*self.n/np.sqrt(2)
+    
+    # function to generate nt time steps of noise (nt x n, or
+    # nt x members x n for an ensemble)
+    def generate(self,nt):
+        if self.exact:
+            if self.members is None:
+                x = self.utils.noise(self.alpha,self.nfine,nt)
+            else:
+                x = self.utils.noise(self.alpha,self.nfine,nt*self.members)
+                x = x.reshape(nt,self.members,self.nfine)
+            if self.nfine != self.n:
+                x = self.utils.filterDown(x,int(self.nfine/self.n))
+            return x
+        if self.members is None:
+            z = self.rng.standard_normal((nt,2,len(self.amp)))
+        else:
+            z = np.stack([rng.standard_normal((nt,2,len(self.amp)))
+                          for rng in self.rngs],axis=1)
+        fx = (z[...,0,:]+1j*z[...,1,:])*self.amp
+        return np.fft.irfft(fx,self.n)
+    
+    # function to return the noise for the next time step
+    def next(self):
+        if self.buffer is None or self.index == len(self.buffer):
+            self.buffer = self.generate(self.block)
+            self.index  = 0
+        x = self.buffer[self.index]
+        self.index += 1
+        return x
+    
+    # functions to save and restore the position in the noise stream
+    def state(self):
+        state = {'buffer': self.buffer, 'index': self.index}
+        if not self.exact:
+            rngs = [self.rng] if self.members is None else self.rngs
+            state['rng'] = [rng.bit_generator.state for rng in rngs]
+        return state
+    
+    def set_state(self,state):
+        self.buffer = state['buffer']
+        self.index  = state['index']
+        if not self.exact:
+            rngs = [self.rng] if self.members is None else self.rngs
+            for rng,rng_state in zip(rngs,state['rng']):
+                rng.bit_generator.state = rng_state
+
+# class for spectral derivatives on a fixed periodic grid
+class SpectralOperator:
+
+    # initializer to precompute wavenumbers for nx points with spacing dx
+    def __init__(self,nx,dx):
+        
+        # signal shape information
+        self.nx = int(nx)
+        self.dx = dx
+        self.m  = int(self.nx/2)
+        
+        # Fourier colocation method with real-to-complex transforms
+        h       = 2*np.pi/self.nx
+        fac     = h/dx
+        k       = np.fft.rfftfreq(self.nx,d=1/self.nx)
+        k[self.m] = 0
+        self.k    = k
+        self.fac  = fac
+        self.ik   = 1j*fac*k
+        self.k2   = -(fac*k)**2
+        self.ik3  = -1j*(fac*k)**3
+    
+    # function to compute only the requested spatial derivatives
+    # (fields may be stacked, derivatives are taken along the last axis)
+    def derivative(self,u,*names):
+        
+        # all derivatives when none are named
+        if not names:
+            names = ('dudx','du2dx','d2udx2','d3udx3')
+        
+        n  = self.nx
+        fu = np.fft.rfft(u)
+        
+        derivatives = {}
+        for name in names:
+            if name == 'dudx':
+                derivatives[name] = np.fft.irfft(self.ik*fu,n)
+            elif name == 'd2udx2':
+                derivatives[name] = np.fft.irfft(self.k2*fu,n)
+            elif name == 'd3udx3':
+                derivatives[name] = np.fft.irfft(self.ik3*fu,n)
+            elif name == 'du2dx':
+                derivatives[name] = np.fft.irfft(self.du2dx_hat(fu),n)
+            else:
+                raise ValueError("Unknown derivative %s"%name)
+        
+        return derivatives
+    
+    # function to compute the spectrum of du2dx from the spectrum of u
+    def du2dx_hat(self,fu):
+        
+        n = self.nx
+        m = self.m
+        
+        # dealiasing needed for du2dx using zero-padding, the
+        # Nyquist mode is split evenly between +m and -m
+        fu_p      = np.zeros(fu.shape[:-1]+(n+1,),dtype=complex)
+        fu_p[...,0:m] = fu[...,0:m]
+        fu_p[...,m]   = fu[...,m]/2
+        u_p       = np.fft.irfft(fu_p,2*n)
+        fu2       = np.fft.rfft(u_p**2)[...,0:m+1]
+        
+        return 2*self.ik*fu2
+    
+    # function to transform to spectral space
+    def fft(self,u):
+        return np.fft.rfft(u)
+    
+    # function to transform back to physical space
+    def ifft(self,fu):
+        return np.fft.irfft(fu,self.nx)
+
+# class to advance the velocity spectrum in time, the viscous term is
+# integrated exactly with an integrating factor and the remaining terms
+# with Euler for the first step and 2nd-order Adams-Bashforth afterwards
+class SpectralIntegrator:
+
+    # initializer to precompute the integrating factor
+    def __init__(self,spectral,visc,dt):
+        self.spectral = spectral
+        self.dt       = dt
+        self.E        = np.exp(visc*spectral.k2*dt)
+        self.E2       = self.E**2
+        self.rhsp     = None
+    
+    # function to advance the spectrum fu given the spectrum of the
+    # non-viscous right hand side
+    def step(self,fu,frhs):
+        dt = self.dt
+        if self.rhsp is None:
+            # Euler for first time step
+            fu_new = self.E*(fu + dt*frhs)
+        else:
+            # 2nd-order Adams-Bashforth
+            fu_new = self.E*fu + dt*(1.5*self.E*frhs - 0.5*self.E2*self.rhsp)
+        
+        # set Nyquist to zero
+        fu_new[...,self.spectral.m] = 0
+        self.rhsp = frhs
+        return fu_new
+    
+    # functions to save and restore the previous right hand side
+    def state(self):
+        return {'rhsp': self.rhsp}
+    
+    def set_state(self,state):
+        self.rhsp = state['rhsp']
+
+# class to advance the velocity spectrum with higher-order schemes for the
+# deterministic terms (ETDRK4 or IMEX-RK) and optional adaptive time steps
+class StiffIntegrator:
+
+    # initializer for the scheme and step size control
+    def __init__(self,spectral,visc,dt,damp=0,scheme="etdrk4",adaptive=False,
+                 cfl=0.5,rtol=1e-3,atol=1e-10,dt_max=None):
+        if scheme not in ("etdrk4","imex"):
+            raise ValueError("scheme must be 'etdrk4' or 'imex'")
+        self.spectral = spectral
+        self.L        = visc*spectral.k2
+        self.damp     = damp
+        self.scheme   = scheme
+        self.adaptive = adaptive
+        self.cfl      = cfl
+        self.rtol     = rtol
+        self.atol     = atol
+        self.dt0      = dt
+        self.dt_max   = 1000*dt if dt_max is None else dt_max
+        self.h        = dt
+        self.coeffs   = {}
+    
+    # function to get the scheme coefficients for a step of size h
+    def coefficients(self,h):
+        if h in self.coeffs:
+            return self.coeffs[h]
+        if len(self.coeffs) > 64:
+            self.coeffs = {}
+        L = self.L
+        if self.scheme == "etdrk4":
+            # contour integral evaluation of the phi functions
+            # (Kassam and Trefethen, 2005)
+            M   = 32
+            r   = np.exp(1j*np.pi*(np.arange(1,M+1)-0.5)/M)
+            LR  = h*L[:,np.newaxis] + r[np.newaxis,:]
+            eLR = np.exp(LR)
+            c = {
+                'E'  :   np.exp(h*L),
+                'E2' :   np.exp(h*L/2),
+                'Q'  :   h*np.real(np.mean((np.exp(LR/2)-1)/LR,axis=1)),
+                'f1' :   h*np.real(np.mean((-4-LR+eLR*(4-3*LR+LR**2))/LR**3,axis=1)),
+                'f2' :   h*np.real(np.mean((2+LR+eLR*(-2+LR))/LR**3,axis=1)),
+                'f3' :   h*np.real(np.mean((-4-3*LR-LR**2+eLR*(4-LR))/LR**3,axis=1)),
+                'p1' :   h*np.real(np.mean((eLR-1)/LR,axis=1))
+            }
+            
+            # variance of the exactly integrated additive noise
+            var = np.full(L.shape,float(h))
+            nz  = L != 0
+            var[nz] = np.expm1(2*h*L[nz])/(2*L[nz])
+            c['sig'] = np.sqrt(2*self.damp*var)
+        else:
+            # ARS(2,2,2) implicit-explicit Runge-Kutta
+            g = 1 - 1/np.sqrt(2)
+            c = {
+                'g'   :   g,
+                'd'   :   1 - 1/(2*g),
+                'inv' :   1/(1 - h*g*L),
+                'ie'  :   1/(1 - h*L),
+                'sig' :   np.full(L.shape,np.sqrt(2*self.damp*h))
+            }
+        self.coeffs[h] = c
+        return c
+    
+    # function to take one deterministic step, returning the new spectrum
+    # and an embedded first-order solution for error control
+    def step(self,fu,h,nonlinear):
+        c  = self.coefficients(h)
+        Nu = nonlinear(fu)
+        if self.scheme == "etdrk4":
+            a  = c['E2']*fu + c['Q']*Nu
+            Na = nonlinear(a)
+            b  = c['E2']*fu + c['Q']*Na
+            Nb = nonlinear(b)
+            cc = c['E2']*a + c['Q']*(2*Nb - Nu)
+            Nc = nonlinear(cc)
+            fu_new = c['E']*fu + Nu*c['f1'] + 2*(Na+Nb)*c['f2'] + Nc*c['f3']
+            fu_low = c['E']*fu + c['p1']*Nu
+        else:
+            g  = c['g']
+            d  = c['d']
+            U1 = c['inv']*(fu + h*g*Nu)
+            N1 = nonlinear(U1)
+            fu_new = c['inv']*(fu + h*(d*Nu + (1-d)*N1) + h*(1-g)*self.L*U1)
+            fu_low = c['ie']*(fu + h*Nu)
+        return fu_new, fu_low
+    
+    # function to integrate fu over a time interval T, landing exactly on T;
+    # forcing returns the spectrum of the unit noise for the next step and
+    # callback(h) is called after every accepted step
+    def advance(self,fu,T,nonlinear,forcing=None,callback=None):
+        m = self.spectral.m
+        t = 0.0
+        while t < T:
+            h = self.h
+            if self.adaptive:
+                # CFL limit from the current velocity
+                umax = np.max(np.abs(self.spectral.ifft(fu)))
+                if umax > 0:
+                    h = min(h,self.cfl*self.spectral.dx/umax)
+                h = self.quantize(h)
+            last = T - t - h < 1e-9*self.dt0
+            if last:
+                h = T - t
+            fu_new, fu_low = self.step(fu,h,nonlinear)
+            if self.adaptive:
+                # error relative to the embedded first-order solution
+                scale = self.atol + self.rtol*np.sqrt(np.mean(np.abs(fu_new)**2))
+                err   = np.sqrt(np.mean(np.abs(fu_new-fu_low)**2))/scale
+                fac   = 0.9*err**-0.5 if err > 0 else 2.0
+                if err > 1 and h > self.dt0*1e-3:
+                    self.h = h*max(0.2,fac)
+                    continue
+                self.h = min(self.dt_max,h*min(2.0,max(0.2,fac)))
+            
+            # add the stochastic forcing for this step
+            if forcing is not None:
+                fu_new = fu_new + self.coefficients(h)['sig']*forcing()
+            
+            # set Nyquist to zero
+            fu_new[...,m] = 0
+            fu = fu_new
+            t  = T if last else t + h
+            if callback is not None:
+                callback(h)
+        return fu
+    
+    # function to round a step down to a fixed geometric ladder so that
+    # scheme coefficients can be reused
+    def quantize(self,h):
+        j = np.floor(4*np.log2(h/self.dt0))
+        return min(self.dt_max,self.dt0*2**(j/4))
+    
+    # functions to save and restore the current (adaptive) step size
+    def state(self):
+        return {'h': self.h}
+    
+    def set_state(self,state):
+        self.h = state['h']
+
+# class to write and read the full solver state of a run, so that a killed
+# run can be continued exactly; files are replaced atomically
+class Checkpoint:
+
+    # initializer with the checkpoint file name
+    def __init__(self,fname):
+        self.fname = fname
+    
+    # function to write a dictionary of state
+    def save(self,**state):
+        path = os.path.dirname(os.path.abspath(self.fname))
+        fd, tmp = tempfile.mkstemp(dir=path,suffix='.tmp')
+        with os.fdopen(fd,'wb') as f:
+            pickle.dump(state,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp,self.fname)
+    
+    # function to read the state back
+    def load(self):
+        with open(self.fname,'rb') as f:
+            return pickle.load(f)
+
+# class to write records along the unlimited time dimension of a netCDF file
+# from a background thread; records are buffered and written in blocks so
+# that every chunk is written once
+class NetCDFWriter:
+
+    # initializer to open the file with the output settings
+    #   buffer      number of records written per block
+    #   threaded    write from a background thread
+    #   zlib        compress record variables (with complevel)
+    #   precision   float type of record variables ("f4" or "f8")
+    #   digits      number of significant digits kept in variables
+    #               created with quantize (the velocity), which makes
+    #               compression far more effective; needs netCDF4 >= 1.6
+    #   layout      "snapshot" (netCDF default chunks) or "time" (a chunk
+    #               holds buffer records of xchunk points, fast time series
+    #               reads at a single point)
+    #   chunks      explicit chunk shape for the velocity, overrides layout
+    def __init__(self,fname,mode='w',buffer=10,threaded=True,zlib=False,
+                 complevel=4,precision="f4",digits=None,layout="snapshot",
+                 chunks=None,xchunk=64):
+        self.output    = nc.Dataset(fname,mode)
+        self.buffer    = max(1,int(buffer))
+        self.zlib      = zlib
+        self.complevel = complevel
+        self.precision = precision
+        self.digits    = digits
+        self.layout    = layout
+        self.chunks    = chunks
+        self.xchunk    = xchunk
+        self.pending   = {}
+        self.error     = None
+        self.queue     = None
+        if threaded:
+            self.queue  = queue.Queue(maxsize=4*self.buffer)
+            self.thread = threading.Thread(target=self._run,daemon=True)
+            self.thread.start()
+    
+    # function to add a variable, record variables have time as first
+    # dimension; with quantize, only digits significant digits are kept
+    def create_variable(self,name,dims,long_name,units,record=True,
+                        quantize=False):
+        if not record:
+            var = self.output.createVariable(name,"f4",dims)
+        else:
+            shape = [len(self.output.dimensions[d]) for d in dims[1:]]
+            if self.chunks is not None and len(self.chunks) == len(dims):
+                chunks = list(self.chunks)
+            elif self.layout == "time":
+                chunks = [self.buffer] + [1]*len(shape)
+                if shape:
+                    chunks[-1] = min(shape[-1],self.xchunk)
+            else:
+                chunks = None
+            kwargs = {}
+            if quantize and self.digits is not None:
+                kwargs['significant_digits'] = self.digits
+            var = self.output.createVariable(name,self.precision,dims,
+                                             zlib=self.zlib,
+                                             complevel=self.complevel,
+                                             chunksizes=chunks,**kwargs)
+        var.long_name = long_name
+        var.units = units
+        return var
+    
+    # function to queue one record of each given variable at time index
+    def write(self,index,**records):
+        records = {name: np.array(value) for name,value in records.items()}
+        self._put(('write',(index,records)))
+    
+    # function to write everything queued so far to disk
+    def sync(self):
+        self._put(('sync',None))
+        if self.queue is not None:
+            self.queue.join()
+        self._check()
+    
+    # function to write everything and close the file
+    def close(self):
+        if self.queue is None:
+            self._do('close',None)
+        else:
+            self.queue.put(('close',None))
+            self.thread.join()
+        self._check()
+    
+    def _put(self,item):
+        self._check()
+        if self.queue is None:
+            self._do(*item)
+        else:
+            self.queue.put(item)
+    
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+    
+    def _run(self):
+        while True:
+            command, args = self.queue.get()
+            try:
+                if self.error is None or command == 'close':
+                    self._do(command,args)
+            except Exception as err:
+                self.error = err
+            finally:
+                self.queue.task_done()
+            if command == 'close':
+                break
+    
+    def _do(self,command,args):
+        if command == 'write':
+            index, records = args
+            for name,value in records.items():
+                start, block = self.pending.get(name,(index,[]))
+                if start + len(block) != index:
+                    self._flush(name)
+                    start, block = index, []
+                block.append(value)
+                self.pending[name] = (start,block)
+                if len(block) == self.buffer:
+                    self._flush(name)
+        else:
+            for name in list(self.pending):
+                self._flush(name)
+            if command == 'sync':
+                self.output.sync()
+            else:
+                self.output.close()
+    
+    def _flush(self,name):
+        start, block = self.pending.pop(name,(0,[]))
+        if block:
+            self.output[name][start:start+len(block),...] = np.stack(block)
+
+# class for lazy access to a variable with time as first dimension in a
+# netCDF file, only the requested records or points are read
+class NetCDFReader:
+
+    # initializer to open the file, chunk is the number of records read at
+    # once when iterating over time windows
+    def __init__(self,fname,name='u',chunk=256):
+        self.data  = nc.Dataset(fname,'r')
+        self.var   = self.data[name]
+        self.var.set_auto_mask(False)
+        self.chunk = int(chunk)
+        self.shape = self.var.shape
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    # function to read a slice, e.g. reader[i0:i1] or reader[:,j]
+    def __getitem__(self,key):
+        return self.var[key]
+    
+    # function to iterate over time windows of at most chunk records,
+    # yielding the first index and the records of each window
+    def windows(self,start=0,stop=None):
+        stop = len(self) if stop is None else min(stop,len(self))
+        for i in range(start,stop,self.chunk):
+            yield i, self.var[i:min(i+self.chunk,stop)]
+    
+    # function to read the time series at a single point
+    def column(self,j):
+        return self.var[:,j]
+    
+    def close(self):
+        self.data.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*args):
+        self.close()
+
+# class to pass snapshots from one process to another through a ring buffer
+# in shared memory, for a single producer and a single consumer; the
+# producer waits while all slots hold unread snapshots
+class SnapshotRing:
+
+    # initializer to allocate slots snapshots of the given shape
+    def __init__(self,shape,slots=64,ctx=None):
+        ctx = multiprocessing.get_context() if ctx is None else ctx
+        self.shape  = tuple(np.atleast_1d(shape))
+        self.slots  = int(slots)
+        size        = self.slots*int(np.prod(self.shape))*8
+        self.shm    = shared_memory.SharedMemory(create=True,size=size)
+        self.free   = ctx.Semaphore(self.slots)
+        self.filled = ctx.Semaphore(0)
+        self.count  = ctx.Value('q',0,lock=False)
+        self.done   = ctx.Event()
+        self.owner  = os.getpid()
+        self._attach()
+    
+    def _attach(self):
+        self.buffer = np.ndarray((self.slots,)+self.shape,dtype=np.float64,
+                                 buffer=self.shm.buf)
+        self.written = self.count.value
+        self.read    = 0
+    
+    # the ring is handed to the producer process without the local view,
+    # only the creating process removes the shared memory
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['buffer']
+        return state
+    
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._attach()
+    
+    # function for the producer to add a snapshot
+    def put(self,u):
+        self.free.acquire()
+        self.buffer[self.written%self.slots] = u
+        self.written += 1
+        self.count.value = self.written
+        self.filled.release()
+    
+    # function for the producer to mark the end of the stream
+    def close(self):
+        self.done.set()
+        self.filled.release()
+    
+    # function for the consumer to take the next snapshot, returns None at
+    # the end of the stream (or when none is ready and block is False)
+    def get(self,block=True):
+        if not self.filled.acquire(block):
+            return None
+        if self.read == self.count.value:
+            # end of stream, leave the marker for later calls
+            self.filled.release()
+            return None
+        u = self.buffer[self.read%self.slots].copy()
+        self.read += 1
+        self.free.release()
+        return u
+    
+    # function to check whether every snapshot of a closed stream was read
+    def finished(self):
+        return self.done.is_set() and self.read == self.count.value
+    
+    # function to release the shared memory
+    def release(self):
+        del self.buffer
+        self.shm.close()
+        if self.owner == os.getpid():
+            self.shm.unlink()
+
 # class to read input settings
 class Settings:
 
@@ -146,23 +757,290 @@ class Settings:
         self.dt    = data["dt"]
         self.visc  = data["visc"]
         self.damp  = data["damp"]
+        self.noise = data.get("noise","exact")
+        self.integrator = data.get("integrator","ab2")
+        self.adaptive   = data.get("adaptive",False)
+        self.cfl        = data.get("cfl",0.5)
+        self.rtol       = data.get("rtol",1e-3)
+        self.ensemble   = data.get("ensemble",1)
+        self.seed       = data.get("seed",1)
+        self.checkpoint = data.get("checkpoint",0)
+        self.output     = data.get("output",{})
+        self.coupled    = data.get("coupled",{})
+        self.tau_file   = data["les"].get("tau_file",None)
+        self.chunk      = data["les"].get("chunk",256)
+        self.closure    = data["les"].get("closure","poly")
+        self.table_size = data["les"].get("table_size",1024)
+        self.smooth     = data["les"].get("table_smooth",5)
+
+# base class for subgrid models, built once per LES grid
+class SGSModel:
+    
+    name = "No model"
+    
+    # initializer to store settings, grid and operators for the run
+    def __init__(self,settings,nx,dx,utils=None,spectral=None):
+        self.settings = settings
+        self.nx       = int(nx)
+        self.dx       = dx
+        self.dt       = settings.dt if settings is not None else None
+        self.utils    = Utils() if utils is None else utils
+        self.spectral = SpectralOperator(nx,dx) if spectral is None else spectral
+    
+    # function to compute subgrid terms for the current time step
+    def step(self,u,dudx):
+        sgs = {
+            'tau'   :   np.zeros(self.nx),
+            'coeff' :   0
+        }
+        return sgs
+    
+    # function to compute the dealiased |dudx|*dudx
+    def dealiased_product(self,dudx):
+        n      = self.nx
+        d      = self.utils.dealias1(np.stack((np.abs(dudx),dudx)),n)
+        return self.utils.dealias2(d[0]*d[1],n)
+
+# constant coefficient Smagorinsky
+class Smagorinsky(SGSModel):
+    
+    name = "Constant-coefficient Smagorinsky"
+    
+    def step(self,u,dudx):
+        CS2   = 0.16**2
+        d3    = self.dealiased_product(dudx)
+        tau   = -2*CS2*(self.dx**2)*d3
+        coeff = np.sqrt(CS2)
+
+        sgs = {
+            'tau'   :   tau,
+            'coeff' :   coeff
+        }
+        return sgs
+
+# dynamic Smagorinsky
+class DynamicSmagorinsky(SGSModel):
+    
+    name = "Dynamic Smagorinsky"
+    
+    def step(self,u,dudx):
+        dx    = self.dx
+        T     = np.abs(dudx)*dudx
+        f     = self.utils.filterBox(np.stack((u,u**2,dudx,T)),2)
+        uf, uuf, dudxf, Tf = f
+        L11   = uuf - uf*uf
+        M11   = -2*(dx**2)*(4*np.abs(dudxf)*dudxf - Tf )
+        if np.mean(M11*M11) == 0:
+            CS2 = 0
+        else:
+            CS2 = np.mean(L11*M11)/np.mean(M11*M11)
+        if CS2 < 0: 
+            CS2 = 0
+        d3    = self.dealiased_product(dudx)
+        tau   = -2*CS2*(dx**2)*d3
+        coeff = np.sqrt(CS2)
+        
+        sgs = {
+            'tau'   :   tau,
+            'coeff' :   coeff
+        }
+        return sgs
+
+# dynamic Wong-Lilly
+class WongLilly(SGSModel):
+    
+    name = "Dynamic Wong-Lilly"
+    
+    def step(self,u,dudx):
+        dx    = self.dx
+        f     = self.utils.filterBox(np.stack((u,u**2,dudx)),2)
+        uf, uuf, dudxf = f
+        L11   = uuf - uf*uf
+        M11   = 2*(dx**(4/3))*dudxf*(1-2**(4/3))
+        if np.mean(M11*M11) == 0:
+            CWL = 0
+        else:
+            CWL = np.mean(L11*M11)/np.mean(M11*M11)
+        if CWL < 0:
+            CWL = 0
+        tau   = -2*CWL*(dx**(4/3))*dudx
+        coeff = CWL
+
+        sgs = {
+            'tau'   :   tau,
+            'coeff' :   coeff
+        }
+        return sgs
+
+# Deardorff TKE, the subgrid energy kr is carried between steps
+class Deardorff(SGSModel):
+    
+    name = "Deardorff 1.5-order TKE"
+    
+    def __init__(self,settings,nx,dx,utils=None,spectral=None,kr=None):
+        SGSModel.__init__(self,settings,nx,dx,utils,spectral)
+        self.kr = np.zeros(self.nx) if kr is None else kr
+    
+    def step(self,u,dudx):
+        Ce = 0.70
+        C1 = 0.1
+        dx = self.dx
+        kr = self.kr
+        d3 = self.dealiased_product(dudx)
+
+        derivs_kr  = self.spectral.derivative(np.stack((u*kr,kr)),'dudx')
+        dukrdx     = derivs_kr["dudx"][0]
+        dkrdx      = derivs_kr["dudx"][1]
+        
+        Vt  = C1*dx*(kr**0.5)
+        tau = -2.*Vt*d3
+        zz  = 2*Vt*dkrdx
+
+        dzzdx = self.spectral.derivative(zz,'dudx')["dudx"]
+        
+        dkr  = ( (-1*dukrdx) + (2*Vt*d3*d3) + dzzdx - (Ce*(kr**1.5)/dx) ) * self.dt
+        self.kr = kr + dkr
+        coeff   = C1
+
+        sgs = {
+            'tau'   :   tau,
+            'coeff' :   coeff,
+            'kr'    :   self.kr
+        }
+        return sgs
+
+# Kramers-Moyal closure, tau is advanced as an SDE with polynomial drift
+# and diffusion fitted to DNS data, or with drift and diffusion looked up in
+# a table (x0, dx, [D1; D2]) of the binned values (see KM_utils.KM_table)
+class KMClosure(SGSModel):
+    
+    name = "Kramers-Moyal"
+    
+    def __init__(self,settings,nx,dx,utils=None,spectral=None,
+                 d1_coeffs=None,d2_coeffs=None,tau=None,eta=None,
+                 physical=True,table=None):
+        SGSModel.__init__(self,settings,nx,dx,utils,spectral)
+        self.d1_coeffs = d1_coeffs
+        self.d2_coeffs = d2_coeffs
+        self.set_table(table)
+        self.tau = np.zeros(self.nx) if tau is None else tau
+        self.ftau = self.spectral.fft(self.tau)
+        self.eta = eta
+        self.t   = 0
+        
+        # dtaudx is only returned in physical space when needed
+        self.physical = physical
+    
+    # function to fix tau to known (e.g. DNS) values
+    def reset(self,tau):
+        self.tau  = tau
+        self.ftau = self.spectral.fft(tau)
+    
+    def step(self,u,dudx,dt=None):
+        dt  = self.dt if dt is None else dt
+        tau = self.tau
+        d1_coeffs = self.d1_coeffs
+        d2_coeffs = self.d2_coeffs
+        if self.eta is None:
+            eta = np.random.normal(0,1,self.nx)
+        else:
+            eta = self.eta[int(np.remainder(self.t,len(self.eta)))]
+        if self.table is None:
+            drift = (tau)*d1_coeffs[0]+d1_coeffs[1]
+            diffusion = (tau)**2*d2_coeffs[0]+(tau)*d2_coeffs[1]+d2_coeffs[2]
+        else:
+            drift, diffusion = self.lookup(tau)
+        tau = tau + dt*drift + np.sqrt(2*diffusion*dt)*eta
+        self.tau = tau
+        self.t  += 1
+
+        ftau = self.spectral.fft(tau)
+        self.ftau = ftau
+        sgs = {
+            'tau'    :   tau,
+            'ftau'   :   ftau,
+            'coeff'  :   0
+        }
+        if self.physical:
+            sgs['dtaudx'] = self.spectral.ifft(self.spectral.ik*ftau)
+        return sgs
+    
+    # function to replace the trained drift and diffusion
+    def retrain(self,d1_coeffs,d2_coeffs,table=None):
+        self.d1_coeffs = d1_coeffs
+        self.d2_coeffs = d2_coeffs
+        self.set_table(table)
+    
+    # function to store the table with the slopes to the next entry, so that
+    # a lookup is a single gather of rows [D1, D2, dD1, dD2]
+    def set_table(self,table):
+        self.table = table
+        if table is not None:
+            x0, dx, values = table
+            rows = np.zeros((values.shape[-1],4))
+            rows[:,:2]  = values.T
+            rows[:-1,2:] = np.diff(values,axis=-1).T
+            self.rows = rows
+    
+    # function to interpolate drift and diffusion linearly from the table,
+    # tau outside the table takes the edge values and NaN gives NaN, as with
+    # the polynomials
+    def lookup(self,tau):
+        x0, dx, values = self.table
+        s = np.clip((tau-x0)/dx,0,len(self.rows)-1)
+        i = np.nan_to_num(s).astype(np.intp)
+        r = np.take(self.rows,i,axis=0)
+        return r[...,:2].T + (s-i)*r[...,2:].T
+    
+    # functions to save and restore tau with the trained coefficients
+    def state(self):
+        return {'tau': self.tau, 'ftau': self.ftau, 't': self.t, 'eta': self.eta,
+                'd1_coeffs': self.d1_coeffs, 'd2_coeffs': self.d2_coeffs,
+                'table': self.table}
+    
+    def set_state(self,state):
+        self.tau  = state['tau']
+        self.ftau = state['ftau']
+        self.t    = state['t']
+        self.eta  = state['eta']
+        self.d1_coeffs = state['d1_coeffs']
+        self.d2_coeffs = state['d2_coeffs']
+        self.set_table(state.get('table'))
+
+# subgrid models selectable through the namelist
+SGS_MODELS = {
+    0   :   SGSModel,
+    1   :   Smagorinsky,
+    2   :   DynamicSmagorinsky,
+    3   :   WongLilly,
+    4   :   Deardorff,
+    5   :   Deardorff,
+    6   :   KMClosure
+}
+
+# function to build the selected subgrid model
+def sgs_model(model,settings,nx,dx,**kwargs):
+    if model not in SGS_MODELS:
+        raise Exception("Please choose an SGS model in namelist.\n\
+        0=no model\n\
+        1=constant-coefficient Smagorinsky\n\
+        2=dynamic Smagorinsky\n\
+        3=dynamic Wong-Lilly\n\
+        4=Deardorff 1.5-order TKE\n\
+        6=Kramers-Moyal")
+    return SGS_MODELS[model](settings,nx,dx,**kwargs)
 
 # class to model subgrid terms
+# (kept for existing scripts, the models are built once and reused)
 class BurgersLES:
 
     # initializer to get selected subgrid model
-    def __init__(self,model):
-        self.model = model
-        if self.model==0:
-            print("[pyBurgers: SGS] \t Running with no model")
-        if self.model==1:
-            print("[pyBurgers: SGS] \t Constant-coefficient Smagorinsky")
-        if self.model==2:
-            print("[pyBurgers: SGS] \t Dynamic Smagorinsky")
-        if self.model==3:
-            print("[pyBurgers: SGS] \t Dynamic Wong-Lilly")
-        if self.model==4:
-            print("[pyBurgers: SGS] \t Deardorff 1.5-order TKE")
+    def __init__(self,model,settings=None):
+        self.model    = model
+        self.settings = settings
+        self.sgs      = None
+        if self.model in SGS_MODELS:
+            print("[pyBurgers: SGS] \t %s"%SGS_MODELS[self.model].name)
     
     # function to compute subgrid terms
     def subgrid(self,u,dudx,dx,kr):
@@ -170,156 +1048,14 @@ class BurgersLES:
         # signal size information
         n = int(u.shape[0])
 
-        # instantiate helper classes
-        utils    = Utils()
-        settings = Settings('namelist.json')
+        # build the model on first use
+        if self.sgs is None or self.sgs.nx != n or self.sgs.dx != dx:
+            if self.settings is None:
+                self.settings = Settings('namelist.json')
+            self.sgs = sgs_model(self.model,self.settings,n,dx)
         
-        # no model
-        if self.model==0:
-            sgs = {
-                'tau'   :   np.zeros(n),
-                'coeff' :   0
-            }
-            return sgs
-        
-        # constant coefficient Smagorinsky
-        if self.model==1:
-            CS2   = 0.16**2
-            d1    = utils.dealias1(np.abs(dudx),n)
-            d2    = utils.dealias1(dudx,n)
-            d3    = utils.dealias2(d1*d2,n)
-            tau   = -2*CS2*(dx**2)*d3
-            coeff = np.sqrt(CS2)
-
-            sgs = {
-            'tau'   :   tau,
-            'coeff' :   coeff
-            }
-            return sgs
-        
-        # dynamic Smagorinsky
-        if self.model==2:
-            uf    = utils.filterBox(u,2)
-            uuf   = utils.filterBox(u**2,2)
-            L11   = uuf - uf*uf
-            dudxf = utils.filterBox(dudx,2)
-            T     = np.abs(dudx)*dudx
-            Tf    = utils.filterBox(T,2)   
-            M11   = -2*(dx**2)*(4*np.abs(dudxf)*dudxf - Tf )
-            if np.mean(M11*M11) == 0:
-                CS2 = 0
-            else:
-                CS2 = np.mean(L11*M11)/np.mean(M11*M11)
-            if CS2 < 0: 
-                CS2 = 0
-            d1    = utils.dealias1(np.abs(dudx),n)
-            d2    = utils.dealias1(dudx,n)
-            d3    = utils.dealias2(d1*d2,n)
-            tau   = -2*CS2*(dx**2)*d3
-            coeff = np.sqrt(CS2)
-            
-            sgs = {
-                'tau'   :   tau,
-                'coeff' :   coeff
-            }
-            return sgs
-        
-        # dynamic Wong-Lilly
-        if self.model==3:
-            uf    = utils.filterBox(u,2)
-            uuf   = utils.filterBox(u**2,2)
-            L11   = uuf - uf*uf
-            dudxf = utils.filterBox(dudx,2)
-            M11   = 2*(dx**(4/3))*dudxf*(1-2**(4/3))
-            if np.mean(M11*M11) == 0:
-                CWL = 0
-            else:
-                CWL = np.mean(L11*M11)/np.mean(M11*M11)
-            if CWL < 0:
-                CWL = 0
-            d1    = utils.dealias1(np.abs(dudx),n)
-            d2    = utils.dealias1(dudx,n)
-            d3    = utils.dealias2(d1*d2,n)
-            tau   = -2*CWL*(dx**(4/3))*dudx
-            coeff = CWL
-
-            sgs = {
-                'tau'   :   tau,
-                'coeff' :   coeff
-            }
-            return sgs
-        
-        # Deardorff TKE
-        if self.model==4:
-            Ce = 0.70
-            C1 = 0.1
-            dt = settings.dt                                  
-            d1 = utils.dealias1(np.abs(dudx),n)
-            d2 = utils.dealias1(dudx,n)
-            d3 = utils.dealias2(d1*d2,n)
-            print(u)
-            derivs_kru = utils.derivative(u*kr,dx)
-            derivs_kr  = utils.derivative(kr,dx)
-            dukrdx     = derivs_kru["dudx"]
-            dkrdx      = derivs_kr["dudx"]
-            
-            Vt  = C1*dx*(kr**0.5)
-            tau = -2.*Vt*d3
-            zz  = 2*Vt*dkrdx
-
-            derivs_zz = utils.derivative(zz,dx)
-            dzzdx     = derivs_zz["dudx"]
-            
-            dkr  = ( (-1*dukrdx) + (2*Vt*d3*d3) + dzzdx - (Ce*(kr**1.5)/dx) ) * dt
-            kr   = kr + dkr
-            coeff = C1
-
-            sgs = {
-                'tau'   :   tau,
-                'coeff' :   coeff,
-                'kr'    :   kr
-            }
-            return sgs
-        
-        if self.model==5:
-            Ce = 0.70
-            C1 = 0.1
-            dt = settings.dt                                  
-            d1 = utils.dealias1(np.abs(dudx),n)
-            d2 = utils.dealias1(dudx,n)
-            d3 = utils.dealias2(d1*d2,n)
-
-            derivs_kru = utils.derivative(u*kr,dx)
-            derivs_kr  = utils.derivative(kr,dx)
-            dukrdx     = derivs_kru["dudx"]
-            dkrdx      = derivs_kr["dudx"]
-            
-            Vt  = C1*dx*(kr**0.5)
-            tau = -2.*Vt*d3
-            zz  = 2*Vt*dkrdx
-
-            derivs_zz = utils.derivative(zz,dx)
-            dzzdx     = derivs_zz["dudx"]
-            
-            #source = np.random.normal(0,0.01)
-            #print(np.shape(u))
-            print(u)
-            
-            dkr  = ( (-1*dukrdx) + (2*Vt*d3*d3) + dzzdx - (Ce*(kr**1.5)/dx) ) * dt# + source
-            kr   = kr + dkr
-            coeff = C1
-
-            sgs = {
-                'tau'   :   tau,
-                'coeff' :   coeff,
-                'kr'    :   kr
-            }
-
-        # exception when none selected
-        else:
-            raise Exception("Please choose an SGS model in namelist.\n\
-            0=no model\n\
-            1=constant-coefficient Smagorinsky\n\
-            2=dynamic Smagorinsky\n\
-            3=dynamic Wong-Lilly\n\
-            4=Deardorff 1.5-order TKE")
+        # Deardorff state is passed in by the caller
+        if isinstance(self.sgs,Deardorff):
+            self.sgs.kr = kr
+        
+        return self.sgs.step(u,dudx)
@@ -1,14 +1,17 @@
 #/usr/bin/env python
 # THIS FILE OBTAINED FROM JEREMY GIBBS' PYBURGERS PROJECT
 # https://github.com/jeremygibbs/pyBurgers
+import os
+import sys
 import time
 from sys import stdout
 import numpy as np
-import netCDF4 as nc
-from burgers import Utils, Settings
+from burgers import Settings, SpectralOperator, SpectralIntegrator, StiffIntegrator, FBMNoise, Checkpoint, NetCDFWriter
 
 # DNS run loop
-def main():
+# (snapshots are also passed to ring, a SnapshotRing, when given)
+def main(namelist='namelist.json',outfile='pyBurgersDNS.nc',restart=False,
+         ring=None):
 
     # let's time this thing
     t1 = time.time()
@@ -24,8 +27,7 @@ def main():
 
     # instantiate helper classes
     print("[pyBurgers: Setup] \t Reading input settings")
-    utils    = Utils()
-    settings = Settings('namelist.json')
+    settings = Settings(namelist)
 
     # input settings
     nx   = settings.nxDNS
@@ -35,91 +37,185 @@ def main():
     nt   = settings.nt
     visc = settings.visc
     damp = settings.damp
+
+    # spectral operator for this grid
+    spectral = SpectralOperator(nx,dx)
+    
+    # ensemble members are advanced together as rows of u
+    ne      = int(settings.ensemble)
+    members = None if ne==1 else ne
     
     # initialize velocity field
     print("[pyBurgers: Setup] \t Initialzing velocity field")
-    u = np.zeros(nx)
+    u = np.zeros(nx) if ne==1 else np.zeros((ne,nx))
 
     # initialize random number generator
-    np.random.seed(1)
+    np.random.seed(settings.seed)
+    noise = FBMNoise(0.75,nx,seed=settings.seed,exact=(settings.noise=="exact"),
+                     members=members)
 
     # place holder for right hand side
     rhsp = 0
+
+    # optionally carry the velocity in spectral space between steps
+    spectral_state = (settings.integrator=="spectral")
+    if spectral_state:
+        integrator = SpectralIntegrator(spectral,visc,dt)
+        fu = spectral.fft(u)
   
-    # create output file
-    print("[pyBurgers: Setup] \t Creating output file")
-    output = nc.Dataset('pyBurgersDNS.nc','w')
-    output.description = "pyBurgers DNS output"
-    output.source = "Jeremy A. Gibbs"
-    output.history = "Created " + time.ctime(time.time())
+    # checkpoints are written next to the output file
+    checkpoint = Checkpoint(os.path.splitext(outfile)[0]+'.chk')
+    t0     = 0
+    save_t = 0
+    if restart:
+        print("[pyBurgers: Setup] \t Restarting from checkpoint")
+        state  = checkpoint.load()
+        t0     = state['t']
+        save_t = state['save_t']
+        u      = state['u']
+        rhsp   = state['rhsp']
+        np.random.set_state(state['random'])
+        noise.set_state(state['noise'])
+        if spectral_state:
+            fu = state['fu']
+            integrator.set_state(state['integrator'])
+  
+    # create output file, or append to it on restart; records are written
+    # from a background thread
+    if restart:
+        print("[pyBurgers: Setup] \t Opening output file")
+        writer = NetCDFWriter(outfile,'a',**settings.output)
+    else:
+        print("[pyBurgers: Setup] \t Creating output file")
+        writer = NetCDFWriter(outfile,'w',**settings.output)
+        output = writer.output
+        output.description = "pyBurgers DNS output"
+        output.source = "Jeremy A. Gibbs"
+        output.history = "Created " + time.ctime(time.time())
     
-    # add dimensions
-    output.createDimension('t')
-    output.createDimension('x',nx)
-
-    # add variables
-    out_t = output.createVariable("t", "f4", ("t"))
-    out_t.long_name = "time"
-    out_t.units = "s"
-    out_x = output.createVariable("x", "f4", ("x"))
-    out_x.long_name = "x-distance"
-    out_x.units = "m"
-    out_k = output.createVariable("tke", "f4", ("t"))
-    out_k.long_name = "turbulence kinetic energy"
-    out_k.units = "m2 s-2"
-    out_u = output.createVariable("u", "f4", ("t","x"))
-    out_u.long_name = "velocity"
-    out_u.units = "m s-1"
-
-    # write x data
-    out_x[:] = np.arange(0,2*np.pi,dx)
+        # add dimensions
+        output.createDimension('t')
+        output.createDimension('x',nx)
+        dims = ("t",)
+        if ne > 1:
+            output.createDimension('e',ne)
+            dims = ("t","e")
+
+        # add variables
+        writer.create_variable("t",("t",),"time","s")
+        out_x = writer.create_variable("x",("x",),"x-distance","m",record=False)
+        writer.create_variable("tke",dims,"turbulence kinetic energy","m2 s-2")
+        writer.create_variable("u",dims+("x",),"velocity","m s-1",quantize=True)
+
+        # write x data
+        out_x[:] = np.arange(0,2*np.pi,dx)
 
     # time loop
-    save_t = 0
-    for t in range(int(nt)):
-
-        # update progress
-        if (t==0 or (t+1)%1000==0):
-            stdout.write("\r[pyBurgers: DNS] \t Running for time %07d of %d"%(t+1,int(nt)))
-            stdout.flush()
-        
-        # compute derivatives
-        derivs = utils.derivative(u,dx)
-        du2dx  = derivs['du2dx']
-        d2udx2 = derivs['d2udx2'] 
-
-        # add fractional Brownian motion (FBM) noise
-        fbm = utils.noise(0.75,nx)
-
-        # compute right hand side
-        rhs = visc * d2udx2 - 0.5*du2dx + np.sqrt(2*damp/dt)*fbm
+    if settings.integrator in ("etdrk4","imex"):
         
-        # time integration
-        if t == 0:
-            # Euler for first time step
-            u_new = u + dt*rhs
+        # higher-order schemes advance one output interval (1000 time
+        # steps of dt) at a time and land exactly on the output times
+        stepper = StiffIntegrator(spectral,visc,dt,damp,
+                                  scheme=settings.integrator,
+                                  adaptive=settings.adaptive,
+                                  cfl=settings.cfl,rtol=settings.rtol)
+        if restart:
+            fu = state['fu']
+            stepper.set_state(state['integrator'])
         else:
-            # 2nd-order Adams-Bashforth
-            u_new = u + dt*(1.5*rhs - 0.5*rhsp)
-        
-        # set Nyquist to zero
-        fu_new     = np.fft.fft(u_new)
-        fu_new[mp] = 0
-        u_new      = np.real(np.fft.ifft(fu_new))
-        u          = u_new
-        rhsp       = rhs
-
-        # output to file every 1000 time steps (0.1 seconds)
-        if ((t+1)%1000==0):          
+            fu = spectral.fft(u)
+        nonlinear = lambda fu: -0.5*spectral.du2dx_hat(fu)
+        forcing   = lambda: spectral.fft(noise.next())
+        for save_t in range(save_t,int(nt)//1000):
+            
+            # update progress
+            stdout.write("\r[pyBurgers: DNS] \t Running for time %07d of %d"%((save_t+1)*1000,int(nt)))
+            stdout.flush()
+            
+            fu = stepper.advance(fu,1000*dt,nonlinear,forcing)
+            u  = spectral.ifft(fu)
             
             # kinetic energy
-            tke  = 0.5*np.var(u)
+            tke  = 0.5*np.var(u,axis=-1)
             
             # save to disk
-            out_t[save_t]   = (t+1)*dt 
-            out_k[save_t]   = tke
-            out_u[save_t,:] = u
-            save_t += 1
+            writer.write(save_t,t=(save_t+1)*1000*dt,tke=tke,u=u)
+            if ring is not None:
+                ring.put(u)
+            
+            # write a checkpoint every few outputs
+            if settings.checkpoint and (save_t+1)%settings.checkpoint==0:
+                writer.sync()
+                checkpoint.save(t=(save_t+1)*1000,save_t=save_t+1,u=u,rhsp=rhsp,
+                                fu=fu,integrator=stepper.state(),
+                                random=np.random.get_state(),noise=noise.state())
+    else:
+        for t in range(t0,int(nt)):
+
+            # update progress
+            if (t==0 or (t+1)%1000==0):
+                stdout.write("\r[pyBurgers: DNS] \t Running for time %07d of %d"%(t+1,int(nt)))
+                stdout.flush()
+        
+            # add fractional Brownian motion (FBM) noise
+            fbm = noise.next()
+
+            if spectral_state:
+                # right hand side without viscosity in spectral space
+                frhs = -0.5*spectral.du2dx_hat(fu) + np.sqrt(2*damp/dt)*spectral.fft(fbm)
+                fu   = integrator.step(fu,frhs)
+            else:
+                # compute derivatives
+                derivs = spectral.derivative(u,'du2dx','d2udx2')
+                du2dx  = derivs['du2dx']
+                d2udx2 = derivs['d2udx2'] 
+
+                # compute right hand side
+                rhs = visc * d2udx2 - 0.5*du2dx + np.sqrt(2*damp/dt)*fbm
+            
+                # time integration
+                if t == 0:
+                    # Euler for first time step
+                    u_new = u + dt*rhs
+                else:
+                    # 2nd-order Adams-Bashforth
+                    u_new = u + dt*(1.5*rhs - 0.5*rhsp)
+            
+                # set Nyquist to zero
+                fu_new         = np.fft.fft(u_new)
+                fu_new[...,mp] = 0
+                u_new          = np.real(np.fft.ifft(fu_new))
+                u              = u_new
+                rhsp           = rhs
+
+            # output to file every 1000 time steps (0.1 seconds)
+            if ((t+1)%1000==0):          
+            
+                # velocity in physical space
+                if spectral_state:
+                    u = spectral.ifft(fu)
+            
+                # kinetic energy
+                tke  = 0.5*np.var(u,axis=-1)
+            
+                # save to disk
+                writer.write(save_t,t=(t+1)*dt,tke=tke,u=u)
+                if ring is not None:
+                    ring.put(u)
+                save_t += 1
+                
+                # write a checkpoint every few outputs
+                if settings.checkpoint and save_t%settings.checkpoint==0:
+                    writer.sync()
+                    state = {'t': t+1, 'save_t': save_t, 'u': u, 'rhsp': rhsp,
+                             'random': np.random.get_state(),
+                             'noise': noise.state()}
+                    if spectral_state:
+                        state['fu'] = fu
+                        state['integrator'] = integrator.state()
+                    checkpoint.save(**state)
+
+    writer.close()
 
     # time info
     t2 = time.time()
@@ -129,4 +225,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    main(restart='--restart' in sys.argv[1:])
@@ -7,12 +7,14 @@ Created on Mon May  8 20:39:39 2023
     https://github.com/jeremygibbs/pyBurgers
     Additions have been made for a KM closure calculated from DNS
 """
+import os
+import sys
 import time
 from sys import stdout
 import numpy as np
 import netCDF4 as nc
-from burgers import Utils, Settings, BurgersLES
-from KM_utils import find_KM_fit_coeffs, KM
+from burgers import Utils, Settings, SpectralOperator, SpectralIntegrator, StiffIntegrator, FBMNoise, KMClosure, Checkpoint, NetCDFWriter, NetCDFReader
+from KM_utils import KMCache, train_KM, KM_table
 
 utils = Utils()
 
@@ -23,7 +25,8 @@ def findTau(u_ss, delta_f=1,len_x=2*np.pi):
     Parameters
     ----------
     u_ss : TYPE numpy array
-        Velocity series (spatial).
+        Velocity series (spatial). Several snapshots can be stacked as rows
+        (time x space).
     delta_f : TYPE, integer
         Filter size ratio. The default is 1.
     len_x : TYPE, float
@@ -32,7 +35,9 @@ def findTau(u_ss, delta_f=1,len_x=2*np.pi):
     Returns
     -------
     tau : TYPE numpy array
-        Numpy array with length = len(u_ss)/delta_f.
+        Numpy array with length = len(u_ss)/delta_f (per row).
+    dtaudx : TYPE numpy array
+        Spatial derivative of tau, same shape as tau.
 
     """
     uf = utils.filterDown(u_ss,delta_f)
@@ -40,13 +45,138 @@ def findTau(u_ss, delta_f=1,len_x=2*np.pi):
     term1 = utils.filterDown(u2,delta_f)
     term2 = uf*uf
     tau = term1 - term2
-    dx = len_x/(len(tau))
+    dx = len_x/(np.shape(tau)[-1])
     der = utils.derivative(tau,dx)
     return tau, der['dudx']
 
+def extractTau(dns, delta_f=1, len_x=2*np.pi, chunk=256, tau_fname=None,
+               lazy=False):
+    """
+    Find tau and its derivative for every snapshot in a DNS output file.
+
+    Parameters
+    ----------
+    dns : TYPE, string or NetCDFReader
+        DNS output file, or a reader over its velocity u (time x space).
+    delta_f : TYPE, integer
+        Filter size ratio. The default is 1.
+    len_x : TYPE, float
+        Length of entire spatial domain. The default is 2*np.pi.
+    chunk : TYPE, integer
+        Number of snapshots read and filtered at once. The default is 256.
+    tau_fname : TYPE, string, optional
+        Training file for the results. If it exists and was made from the
+        same DNS file (path, size and modification time) with the same
+        filter and domain length it is read instead, otherwise it is written
+        window by window. The default is None.
+    lazy : TYPE, boolean
+        Return readers over the training file instead of arrays, so that
+        no more than chunk snapshots are held in memory. Needs tau_fname.
+        The default is False.
+
+    Returns
+    -------
+    tau : TYPE numpy array or NetCDFReader
+        Filtered subgrid stress (time x space/delta_f).
+    dtaudx : TYPE numpy array or NetCDFReader
+        Spatial derivative of tau, same shape as tau.
+
+    """
+    reader = NetCDFReader(dns,'u',chunk) if isinstance(dns,str) else dns
+    nt, nx = reader.shape
+    n = nx//delta_f
+    
+    # the DNS file the training file is made from
+    source = os.path.abspath(reader.data.filepath())
+    stat   = os.stat(source)
+    origin = {
+        'source'       : source,
+        'source_size'  : stat.st_size,
+        'source_mtime' : stat.st_mtime,
+        'delta_f'      : delta_f,
+        'len_x'        : len_x,
+    }
+    
+    current = False
+    if tau_fname is not None and os.path.exists(tau_fname):
+        with nc.Dataset(tau_fname,'r') as train:
+            current = (all(name in train.ncattrs() and train.getncattr(name) == value
+                           for name,value in origin.items()) and
+                       train.dimensions['t'].size == nt)
+    
+    if tau_fname is None:
+        tau    = np.empty((nt,n))
+        dtaudx = np.empty((nt,n))
+        for i, u in reader.windows():
+            tau[i:i+len(u)], dtaudx[i:i+len(u)] = findTau(u,delta_f,len_x)
+    elif not current:
+        # time contiguous chunks for fast reads of single points
+        with nc.Dataset(tau_fname,'w') as train:
+            train.description = "Subgrid stress filtered from DNS"
+            train.setncatts(origin)
+            train.createDimension('t',nt)
+            train.createDimension('x',n)
+            for name in ('tau','dtaudx'):
+                train.createVariable(name,'f8',('t','x'),
+                                     chunksizes=(min(nt,chunk),min(n,64)))
+            for i, u in reader.windows():
+                tau_i, dtaudx_i = findTau(u,delta_f,len_x)
+                train['tau'][i:i+len(u)]    = tau_i
+                train['dtaudx'][i:i+len(u)] = dtaudx_i
+    if reader is not dns:
+        reader.close()
+    
+    if tau_fname is None:
+        return tau, dtaudx
+    if lazy:
+        return NetCDFReader(tau_fname,'tau',chunk), NetCDFReader(tau_fname,'dtaudx',chunk)
+    with NetCDFReader(tau_fname,'tau') as tau, NetCDFReader(tau_fname,'dtaudx') as dtaudx:
+        return tau[:], dtaudx[:]
+
+def trainClosure(tau_series, settings, dt=0.1, cache=None):
+    """
+    Train the KM closure on a time series of tau at a single point.
+
+    Parameters
+    ----------
+    tau_series : TYPE, numpy array
+        Time series of tau.
+    settings : TYPE, Settings
+        Run settings, selecting the polynomial or tabulated closure.
+    dt : TYPE, float
+        Time step of the time series. The default is 0.1.
+    cache : TYPE, KMCache
+        Cache for the trained results. The default is None.
+
+    Returns
+    -------
+    d1_coeffs : TYPE, numpy array
+        Polynomial fit of D1.
+    d2_coeffs : TYPE, numpy array
+        Polynomial fit of D2.
+    table : TYPE, tuple or None
+        Lookup table of the binned D1 and D2 (see KM_utils.KM_table) when
+        the tabulated closure is selected.
+
+    """
+    km = train_KM(tau_series, dt=dt, lambda_1=False, num_bins=200, cache=cache)
+    
+    # Optionally look drift and diffusion up in a table of the binned
+    # values instead of evaluating the polynomial fits
+    table = None
+    if settings.closure == "table":
+        table = KM_table(km['bins'],km['D1_e'],km['D2_e'],
+                         num=settings.table_size,smooth=settings.smooth)
+    return km['D1_coeffs'], km['D2_coeffs'], table
+
 
 # LES solver
-def main():
+#   tau_dns   subgrid stress to train on and reset to (time x space) in place
+#             of the DNS file, e.g. a stream of it from a running DNS
+#   refresh   function called as refresh(save_t,closure) after every output
+def main(namelist='namelist.json',dns_fname='pyBurgersDNS.nc',
+         outfile='pyBurgersLES_KMfromDNS.nc',restart=False,tau_dns=None,
+         refresh=None):
 
     # Let's time this thing
     t1 = time.time()
@@ -63,7 +193,7 @@ def main():
     # Instantiate helper classes
     print("[pyBurgers: Setup] \t Reading input settings")
     utils    = Utils()
-    settings = Settings('namelist.json')
+    settings = Settings(namelist)
     
     nxDNS = settings.nxDNS
     nxLES = 512
@@ -74,33 +204,38 @@ def main():
     visc  = settings.visc
     damp  = settings.damp
 
-    # Define the filename for the DNS training data
-    dns_fname = 'pyBurgersDNS.nc'
-    
-    dns_data =  nc.Dataset(dns_fname,'r')
-    
-    u_dns = dns_data['u'][:]
-    dns_data.close()
+    # Spectral operator for the LES grid
+    spectral = SpectralOperator(nxLES,dx)
 
     # Define the time step for the DNS data training
     dt_DNS = 0.1
         
     # Calculate time series for tau from DNS to train KM model 
-    for i in range(np.shape(u_dns)[0]):
-        tau_i, dtaudx_i = findTau(u_dns[i,:],delta_f=int(nxDNS/nxLES))
-        if 'tau_dns' in locals():
-            tau_dns = np.vstack([tau_dns,tau_i])
-            dtaudx_dns = np.vstack([dtaudx_dns,tau_i])
-        if 'tau_dns' not in locals():
-            tau_dns = tau_i
-            dtaudx_dns = dtaudx_i
+    # (with a training file, tau stays on disk and is read when needed)
+    if tau_dns is None:
+        tau_dns, dtaudx_dns = extractTau(dns_fname,delta_f=int(nxDNS/nxLES),
+                                         chunk=settings.chunk,
+                                         tau_fname=settings.tau_file,
+                                         lazy=settings.tau_file is not None)
     
-    # Find KM Coefficients
-    bins, D1_e, D2_e = KM(tau_dns[:,80], lambda_1=False, dt=dt_DNS, num_bins=200)
-    d1_coeffs, d2_coeffs = find_KM_fit_coeffs(bins,D1_e,D2_e)
+    # Checkpoints are written next to the output file and hold the trained
+    # KM coefficients, so a restart skips training
+    checkpoint = Checkpoint(os.path.splitext(outfile)[0]+'.chk')
+    if restart:
+        print("[pyBurgers: Setup] \t Restarting from checkpoint")
+        state = checkpoint.load()
+        d1_coeffs = state['closure']['d1_coeffs']
+        d2_coeffs = state['closure']['d2_coeffs']
+        table     = state['closure'].get('table')
+        eta       = state['closure']['eta']
+    else:
+        # Find KM Coefficients (reused from the cache for the same training data)
+        d1_coeffs, d2_coeffs, table = trainClosure(tau_dns[:,80],settings,
+                                                   dt=dt_DNS,
+                                                   cache=KMCache('.km_cache'))
     
-    # Initiate random KM (This maintains the seed for the forcing function)
-    eta = np.random.normal(0,1,[int(1000),int(nxLES)])
+        # Initiate random KM (This maintains the seed for the forcing function)
+        eta = np.random.normal(0,1,[int(1000),int(nxLES)])
     
    
     # Initialize velocity field
@@ -108,144 +243,236 @@ def main():
     u = np.zeros(nxLES)
 
     # Initialize random number generator
-    np.random.seed(1)
+    # (exact noise reproduces the filtered DNS forcing realization)
+    np.random.seed(settings.seed)
+    noise = FBMNoise(0.75,nxLES,nfine=nxDNS,seed=settings.seed,
+                     exact=(settings.noise=="exact"))
 
     # Place holder for right hand side
     rhsp = 0
+
+    # Optionally carry the velocity in spectral space between steps
+    spectral_state = (settings.integrator=="spectral")
+    if spectral_state:
+        integrator = SpectralIntegrator(spectral,visc,dt)
+        fu = spectral.fft(u)
+    
+    # Restore the solver state
+    t0     = 0
+    save_t = 0
+    if restart:
+        t0     = state['t']
+        save_t = state['save_t']
+        u      = state['u']
+        rhsp   = state['rhsp']
+        np.random.set_state(state['random'])
+        noise.set_state(state['noise'])
+        if spectral_state:
+            fu = state['fu']
+            integrator.set_state(state['integrator'])
     
-    # Create output file
+    # Create output file, or append to it on restart; records are written
+    # from a background thread.
     # Some info commented out to speed up calculations and minimize output
     # file size.
-    print("[pyBurgers: Setup] \t Creating output file")
-    output = nc.Dataset('pyBurgersLES_KMfromDNS.nc','w')
-    output.description = "pyBurgers KM LES output"
-    output.source = "M. Ross"
-    output.history = "Created " + time.ctime(time.time())
-    #output.setncattr("sgs","%d"%model)
+    if restart:
+        print("[pyBurgers: Setup] \t Opening output file")
+        writer = NetCDFWriter(outfile,'a',**settings.output)
+    else:
+        print("[pyBurgers: Setup] \t Creating output file")
+        writer = NetCDFWriter(outfile,'w',**settings.output)
+        output = writer.output
+        output.description = "pyBurgers KM LES output"
+        output.source = "M. Ross"
+        output.history = "Created " + time.ctime(time.time())
+        #output.setncattr("sgs","%d"%model)
     
-    # Add dimensions
-    output.createDimension('t')
-    output.createDimension('x',nxLES)
-
-    # Add variables
-    out_t = output.createVariable("t", "f4", ("t"))
-    out_t.long_name = "time"
-    out_t.units = "s"
-    out_x = output.createVariable("x", "f4", ("x"))
-    out_x.long_name = "x-distance"
-    out_x.units = "m"
-    out_k = output.createVariable("tke", "f4", ("t"))
-    out_k.long_name = "turbulence kinetic energy"
-    out_k.units = "m2 s-2"
-    # out_c = output.createVariable("C", "f4", ("t"))
-    # out_c.long_name = "subgrid model coefficient"
-    # out_c.units = "--"
-    # out_ds = output.createVariable("diss_sgs", "f4", ("t"))
-    # out_ds.long_name = "subgrid dissipation"
-    # out_ds.units = "m2 s-3"
-    # out_dm = output.createVariable("diss_mol", "f4", ("t"))
-    # out_dm.long_name = "molecular dissipation"
-    # out_dm.units = "m2 s-3"
-    # out_ep = output.createVariable("ens_prod", "f4", ("t"))
-    # out_ep.long_name = "enstrophy production"
-    # out_ep.units = "s-3"
-    # out_eds = output.createVariable("ens_diss_sgs", "f4", ("t"))
-    # out_eds.long_name = "subgrid enstrophy dissipation"
-    # out_eds.units = "s-3"
-    # out_edm = output.createVariable("ens_diss_mol", "f4", ("t"))
-    # out_edm.long_name = "molecular enstrophy dissipation"
-    # out_edm.units = "s-3"
-    out_u = output.createVariable("u", "f4", ("t","x"))
-    out_u.long_name = "velocity"
-    out_u.units = "m s-1"
-
-    # Write x data
-    out_x[:] = np.arange(0,2*np.pi,dx)
+        # Add dimensions
+        output.createDimension('t')
+        output.createDimension('x',nxLES)
+
+        # Add variables
+        writer.create_variable("t",("t",),"time","s")
+        out_x = writer.create_variable("x",("x",),"x-distance","m",record=False)
+        writer.create_variable("tke",("t",),"turbulence kinetic energy","m2 s-2")
+        # out_c = output.createVariable("C", "f4", ("t"))
+        # out_c.long_name = "subgrid model coefficient"
+        # out_c.units = "--"
+        # out_ds = output.createVariable("diss_sgs", "f4", ("t"))
+        # out_ds.long_name = "subgrid dissipation"
+        # out_ds.units = "m2 s-3"
+        # out_dm = output.createVariable("diss_mol", "f4", ("t"))
+        # out_dm.long_name = "molecular dissipation"
+        # out_dm.units = "m2 s-3"
+        # out_ep = output.createVariable("ens_prod", "f4", ("t"))
+        # out_ep.long_name = "enstrophy production"
+        # out_ep.units = "s-3"
+        # out_eds = output.createVariable("ens_diss_sgs", "f4", ("t"))
+        # out_eds.long_name = "subgrid enstrophy dissipation"
+        # out_eds.units = "s-3"
+        # out_edm = output.createVariable("ens_diss_mol", "f4", ("t"))
+        # out_edm.long_name = "molecular enstrophy dissipation"
+        # out_edm.units = "s-3"
+        writer.create_variable("u",("t","x"),"velocity","m s-1",quantize=True)
+
+        # Write x data
+        out_x[:] = np.arange(0,2*np.pi,dx)
  
+
     # Time loop
-    save_t = 0
     #dtaudx = np.zeros(nxLES)
     # Initiate tau value
-    tau = tau_dns[0,:]
-    tau_deriv = utils.derivative(tau,dx)
-    dtaudx = tau_deriv['dudx']
-    for t in range(int(nt)):
-        
-        # Update progress
-        if (t==0 or (t+1)%1000==0):
-            stdout.write("\r[pyBurgers: LES] \t Running for time %07d of %d"%(t+1,int(nt)))
-            stdout.flush()
-        
-        # Compute derivatives
-        derivs = utils.derivative(u,dx)
-        dudx   = derivs['dudx']
-        du2dx  = derivs['du2dx']
-        d2udx2 = derivs['d2udx2']
-        #d3udx3 = derivs['d3udx3']
-
-        # Add fractional Brownian motion (FBM) noise
-        fbm  = utils.noise(0.75,nxDNS)
-        #fbmf = utils.noise(0.75,nxLES)
-        fbmf = utils.filterDown(fbm,int(nxDNS/nxLES))
-
-        # # compute subgrid terms from KM
-        #tau = findTau(u, delta_f=1,len_x=2*np.pi)
-        drift = (tau)*d1_coeffs[0]+d1_coeffs[1]
-        diffusion = (tau)**2*d2_coeffs[0]+(tau)*d2_coeffs[1]+d2_coeffs[2]
-        #diffusion = dtaudx**2*d2_coeffs[0]+dtaudx*d2_coeffs[1]+d2_coeffs[2]
-        tau = tau + dt*drift + np.sqrt(2*diffusion*dt)*eta[int(np.remainder(t,1000)-0),:]#np.random.normal(0,1,nxLES)
-        tau_deriv = utils.derivative(tau,dx)
-        dtaudx = tau_deriv['dudx']
-
-        # Compute right hand side
-        rhs = visc * d2udx2 - 0.5*du2dx + np.sqrt(2*damp/dt)*fbmf - 0.5*dtaudx
+    closure = KMClosure(settings,nxLES,dx,utils,spectral,d1_coeffs=d1_coeffs,
+                        d2_coeffs=d2_coeffs,tau=tau_dns[0,:],eta=eta,
+                        physical=not spectral_state,table=table)
+    if restart:
+        closure.set_state(state['closure'])
+    if settings.integrator in ("etdrk4","imex"):
         
-        # Time integration
-        if t == 0:
-            # Euler for first time step
-            u_new = u + dt*rhs
+        # Higher-order schemes advance one output interval (1000 time
+        # steps of dt) at a time and land exactly on the output times.
+        # tau is held over each step and advanced after it is accepted.
+        closure.physical = False
+        stepper = StiffIntegrator(spectral,visc,dt,damp,
+                                  scheme=settings.integrator,
+                                  adaptive=settings.adaptive,
+                                  cfl=settings.cfl,rtol=settings.rtol)
+        if restart:
+            fu = state['fu']
+            stepper.set_state(state['integrator'])
         else:
-            # 2nd-order Adams-Bashforth
-            u_new = u + dt*(1.5*rhs - 0.5*rhsp)
-        
-        # Set Nyquist to zero
-        fu_new     = np.fft.fft(u_new)
-        fu_new[mp] = 0
-        u_new      = np.real(np.fft.ifft(fu_new))
-        u          = u_new
-        rhsp       = rhs
-
-        # Output to file every 1000 time steps (0.1 seconds)
-        if ((t+1)%1000==0):
+            fu = spectral.fft(u)
+        nonlinear = lambda fu: -0.5*spectral.du2dx_hat(fu) - 0.5*spectral.ik*closure.ftau
+        forcing   = lambda: spectral.fft(noise.next())
+        advance   = lambda h: closure.step(None,None,dt=h)
+        for save_t in range(save_t,int(nt)//1000):
+            
+            # Update progress
+            stdout.write("\r[pyBurgers: LES] \t Running for time %07d of %d"%((save_t+1)*1000,int(nt)))
+            stdout.flush()
+            
+            fu = stepper.advance(fu,1000*dt,nonlinear,forcing,advance)
+            u  = spectral.ifft(fu)
             
             # Fix the tau value to the DNS data every available time step
-            tau = tau_dns[save_t,:]
+            closure.reset(tau_dns[save_t,:])
             
             # Kinetic energy
             tke  = 0.5*np.var(u)
+            
+            # Save to disk
+            writer.write(save_t,t=(save_t+1)*1000*dt,tke=tke,u=u)
+            
+            # Update the closure, e.g. retrain on new DNS data
+            if refresh is not None:
+                refresh(save_t,closure)
+            
+            # Write a checkpoint every few outputs
+            if settings.checkpoint and (save_t+1)%settings.checkpoint==0:
+                writer.sync()
+                checkpoint.save(t=(save_t+1)*1000,save_t=save_t+1,u=u,rhsp=rhsp,
+                                fu=fu,integrator=stepper.state(),
+                                closure=closure.state(),
+                                random=np.random.get_state(),noise=noise.state())
+    else:
+        for t in range(t0,int(nt)):
+        
+            # Update progress
+            if (t==0 or (t+1)%1000==0):
+                stdout.write("\r[pyBurgers: LES] \t Running for time %07d of %d"%(t+1,int(nt)))
+                stdout.flush()
+        
+            # Add fractional Brownian motion (FBM) noise
+            fbmf = noise.next()
 
-            # Dissipation
-            #diss_sgs = np.mean(-tau*dudx)
-            #diss_mol = np.mean(visc*dudx**2)
+            # # compute subgrid terms from KM
+            sgs    = closure.step(u,None)
 
-            # Enstrophy
-            #ens_prod = np.mean(dudx**3)
-            #ens_dsgs = np.mean(-tau*d3udx3)
-            #ens_dmol = np.mean(visc*d2udx2**2)
+            if spectral_state:
+                # Right hand side without viscosity in spectral space
+                frhs = (-0.5*spectral.du2dx_hat(fu) + np.sqrt(2*damp/dt)*spectral.fft(fbmf)
+                        - 0.5*spectral.ik*sgs['ftau'])
+                fu   = integrator.step(fu,frhs)
+            else:
+                # Compute derivatives
+                derivs = spectral.derivative(u,'du2dx','d2udx2')
+                du2dx  = derivs['du2dx']
+                d2udx2 = derivs['d2udx2']
+                #d3udx3 = derivs['d3udx3']
+                dtaudx = sgs['dtaudx']
+
+                # Compute right hand side
+                rhs = visc * d2udx2 - 0.5*du2dx + np.sqrt(2*damp/dt)*fbmf - 0.5*dtaudx
             
-            # Save to disk
-            out_t[save_t]   = (t+1)*dt 
-            out_k[save_t]   = tke
-            #out_c[save_t]   = coeff
-            #out_ds[save_t]  = diss_sgs
-            #out_dm[save_t]  = diss_mol
-            #out_ep[save_t]  = ens_prod
-            #out_eds[save_t] = ens_dsgs
-            #out_edm[save_t] = ens_dmol
-            out_u[save_t,:] = u
-            save_t += 1
-            #u = u_dns[save_t,::int(nxDNS/nxLES)]
+                # Time integration
+                if t == 0:
+                    # Euler for first time step
+                    u_new = u + dt*rhs
+                else:
+                    # 2nd-order Adams-Bashforth
+                    u_new = u + dt*(1.5*rhs - 0.5*rhsp)
+            
+                # Set Nyquist to zero
+                fu_new     = np.fft.fft(u_new)
+                fu_new[mp] = 0
+                u_new      = np.real(np.fft.ifft(fu_new))
+                u          = u_new
+                rhsp       = rhs
+
+            # Output to file every 1000 time steps (0.1 seconds)
+            if ((t+1)%1000==0):
+            
+                # Velocity in physical space
+                if spectral_state:
+                    u = spectral.ifft(fu)
+            
+                # Fix the tau value to the DNS data every available time step
+                closure.reset(tau_dns[save_t,:])
+            
+                # Kinetic energy
+                tke  = 0.5*np.var(u)
+
+                # Dissipation
+                #diss_sgs = np.mean(-tau*dudx)
+                #diss_mol = np.mean(visc*dudx**2)
+
+                # Enstrophy
+                #ens_prod = np.mean(dudx**3)
+                #ens_dsgs = np.mean(-tau*d3udx3)
+                #ens_dmol = np.mean(visc*d2udx2**2)
+            
+                # Save to disk
+                writer.write(save_t,t=(t+1)*dt,tke=tke,u=u)
+                #out_c[save_t]   = coeff
+                #out_ds[save_t]  = diss_sgs
+                #out_dm[save_t]  = diss_mol
+                #out_ep[save_t]  = ens_prod
+                #out_eds[save_t] = ens_dsgs
+                #out_edm[save_t] = ens_dmol
+                
+                # Update the closure, e.g. retrain on new DNS data
+                if refresh is not None:
+                    refresh(save_t,closure)
+                save_t += 1
+                
+                # Write a checkpoint every few outputs
+                if settings.checkpoint and save_t%settings.checkpoint==0:
+                    writer.sync()
+                    state = {'t': t+1, 'save_t': save_t, 'u': u, 'rhsp': rhsp,
+                             'closure': closure.state(),
+                             'random': np.random.get_state(),
+                             'noise': noise.state()}
+                    if spectral_state:
+                        state['fu'] = fu
+                        state['integrator'] = integrator.state()
+                    checkpoint.save(**state)
+                #u = u_dns[save_t,::int(nxDNS/nxLES)]
     
+    writer.close()
+    if isinstance(tau_dns,NetCDFReader):
+        tau_dns.close()
+        dtaudx_dns.close()
+
     # Time info
     t2 = time.time()
     tt = t2 - t1
@@ -253,4 +480,4 @@ def main():
     print("##############################################################")
 
 if __name__ == "__main__":
-    main()
+    main(restart='--restart' in sys.argv[1:])
@@ -0,0 +1,133 @@
+#/usr/bin/env python
+# Coupled DNS and LES run
+#
+# usage: python burgers_coupled.py
+#
+# The DNS runs in a separate process and passes every output snapshot to the
+# LES through a ring buffer in shared memory. The LES filters the snapshots
+# as they arrive, trains the KM closure once "warmup" snapshots are in, and
+# retrains it on everything received so far every "refresh" outputs, so the
+# LES starts long before the DNS is done. Settings go in an optional
+# "coupled" section of the namelist:
+#
+#   "coupled" : {"warmup": 100, "refresh": 100, "slots": 64}
+#
+# The DNS output file is still written, the console output of the DNS goes
+# to dns.log.
+import os
+import sys
+import time
+import multiprocessing
+import numpy as np
+from burgers import Settings, SnapshotRing
+import burgersDNS
+import burgers_LESKMfromDNS as les
+
+# LES grid of burgers_LESKMfromDNS
+nxLES = 512
+
+# class with array access to tau filtered from a stream of DNS snapshots;
+# reading a row waits for the DNS to get there, reading a column returns
+# every snapshot received so far
+class TauStream:
+
+    # initializer for at most nt snapshots filtered by delta_f, snapshots
+    # that are ready are filtered in batches of up to chunk
+    def __init__(self,ring,nt,delta_f,chunk=64):
+        n = ring.shape[-1]//delta_f
+        self.ring    = ring
+        self.delta_f = delta_f
+        self.chunk   = chunk
+        self.tau     = np.empty((nt,n))
+        self.dtaudx  = np.empty((nt,n))
+        self.n       = 0
+
+    # function to take snapshots from the ring, waiting until count have
+    # arrived and then taking whatever else is ready
+    def pull(self,count=0):
+        while True:
+            block = self.n < count
+            u = self.ring.get(block)
+            if u is None:
+                if block:
+                    raise IndexError("DNS ended after %d snapshots"%self.n)
+                return
+            batch = [u]
+            while len(batch) < self.chunk and self.n+len(batch) < len(self.tau):
+                u = self.ring.get(False)
+                if u is None:
+                    break
+                batch.append(u)
+            i = self.n
+            self.tau[i:i+len(batch)], self.dtaudx[i:i+len(batch)] = \
+                les.findTau(np.array(batch),self.delta_f)
+            self.n += len(batch)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self,key):
+        rows = key[0] if isinstance(key,tuple) else key
+        if isinstance(rows,(int,np.integer)):
+            self.pull(rows+1)
+        else:
+            self.pull()
+        return self.tau[:self.n][key]
+
+# function to run the DNS in the producer process
+def runDNS(namelist,dns_fname,ring,log_fname):
+    with open(log_fname,'w') as log:
+        os.dup2(log.fileno(),1)
+        sys.stdout = os.fdopen(1,'w',buffering=1,closefd=False)
+        try:
+            burgersDNS.main(namelist,dns_fname,ring=ring)
+        finally:
+            ring.close()
+            ring.release()
+
+# coupled run
+def main(namelist='namelist.json',dns_fname='pyBurgersDNS.nc',
+         outfile='pyBurgersLES_KMfromDNS.nc'):
+
+    # let's time this thing
+    t1 = time.time()
+
+    settings = Settings(namelist)
+    warmup   = settings.coupled.get("warmup",100)
+    every    = settings.coupled.get("refresh",100)
+    slots    = settings.coupled.get("slots",64)
+    nout     = int(settings.nt)//1000
+
+    # start the DNS
+    print("[pyBurgers: Coupled] \t Starting DNS, output in dns.log")
+    ring = SnapshotRing(settings.nxDNS,slots)
+    dns  = multiprocessing.Process(target=runDNS,
+                                   args=(namelist,dns_fname,ring,'dns.log'))
+    dns.start()
+
+    # wait for enough snapshots to train the closure
+    stream = TauStream(ring,nout,int(settings.nxDNS/nxLES))
+    print("[pyBurgers: Coupled] \t Waiting for %d DNS snapshots"%warmup)
+    stream.pull(min(warmup,nout))
+
+    # retrain on everything received so far every few outputs
+    def refresh(save_t,closure):
+        if every and (save_t+1)%every == 0:
+            closure.retrain(*les.trainClosure(stream[:,80],settings))
+
+    try:
+        les.main(namelist,dns_fname,outfile,tau_dns=stream,refresh=refresh)
+    except BaseException:
+        dns.terminate()
+        raise
+    finally:
+        dns.join()
+        ring.release()
+
+    # time info
+    t2 = time.time()
+    tt = t2 - t1
+    print("[pyBurgers: Coupled] \t Done! Completed in %0.2f seconds"%tt)
+
+if __name__ == "__main__":
+    main()
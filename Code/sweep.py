@@ -0,0 +1,207 @@
+#/usr/bin/env python
+# Parameter sweeps over namelist configurations
+#
+# usage: python sweep.py sweep.json
+#
+# The sweep file names a base namelist, a grid of values and the runs to do:
+#
+#   {
+#       "namelist" : "namelist.json",
+#       "grid"     : {"visc": [1E-5, 2E-5], "nx": [4096, 8192], "seed": [1, 2]},
+#       "mode"     : "both",
+#       "workers"  : 8,
+#       "output"   : "sweep"
+#   }
+#
+# Grid keys are namelist entries ("visc", "damp", "dt", "nt", "seed", ...),
+# "nx" for the DNS grid size, or any dotted path into the namelist (e.g.
+# "les.chunk"). Every combination becomes a job with its own directory
+# holding its namelist, log and netCDF output (and the tau training file of
+# an LES, when the namelist names one).
+# DNS runs are shared by all LES runs that only differ in LES settings, and
+# are done first. Finished jobs are recorded in a ledger in the output
+# directory so that an interrupted sweep picks up where it stopped.
+import os
+import sys
+import json
+import time
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import burgersDNS
+import burgers_LESKMfromDNS
+
+# short names for nested namelist entries
+ALIASES = {
+    'nx'  : 'dns.nx',
+}
+
+# output file names inside a job directory
+OUTPUT = {
+    'dns' : 'pyBurgersDNS.nc',
+    'les' : 'pyBurgersLES_KMfromDNS.nc',
+}
+
+# function to set a (possibly dotted) namelist entry
+def set_entry(namelist,key,value):
+    path = ALIASES.get(key,key).split('.')
+    node = namelist
+    for name in path[:-1]:
+        node = node.setdefault(name,{})
+    node[path[-1]] = value
+
+# function to expand a grid into a list of namelists with their grid values
+def expand(base,grid):
+    keys = sorted(grid)
+    jobs = []
+    for values in itertools.product(*(grid[k] for k in keys)):
+        namelist = json.loads(json.dumps(base))
+        for key,value in zip(keys,values):
+            set_entry(namelist,key,value)
+        jobs.append((dict(zip(keys,values)),namelist))
+    return jobs
+
+# function to build a unique job id from the settings a run depends on,
+# DNS runs do not depend on the LES settings
+def job_id(kind,params,namelist):
+    paths = {k: ALIASES.get(k,k) for k in params}
+    if kind == 'dns':
+        namelist = {k: v for k,v in namelist.items() if k != 'les'}
+        paths    = {k: p for k,p in paths.items() if not p.startswith('les.')}
+    label  = "_".join("%s%s"%(paths[k].split('.')[-1],params[k]) for k in sorted(paths))
+    digest = hashlib.sha1(json.dumps(namelist,sort_keys=True).encode())
+    return "%s-%s"%(label or kind,digest.hexdigest()[:8])
+
+# function to read the ids of finished jobs from the ledger
+def read_ledger(fname):
+    done = set()
+    if os.path.exists(fname):
+        with open(fname) as ledger:
+            for line in ledger:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partially written last line
+                    continue
+                if entry['status'] == 'done':
+                    done.add((entry['kind'],entry['job']))
+                else:
+                    done.discard((entry['kind'],entry['job']))
+    return done
+
+# function to run a single job in a worker process, with the console output
+# of the run sent to a log file in the job directory
+def run_job(kind,workdir,dns_fname=None):
+    namelist = os.path.join(workdir,'namelist.json')
+    outfile  = os.path.join(workdir,OUTPUT[kind])
+    t1 = time.time()
+    with open(os.path.join(workdir,'%s.log'%kind),'w') as log:
+        sys.stdout.flush()
+        console = os.dup(1)
+        os.dup2(log.fileno(),1)
+        try:
+            if kind == 'dns':
+                burgersDNS.main(namelist,outfile)
+            else:
+                burgers_LESKMfromDNS.main(namelist,dns_fname,outfile)
+        finally:
+            sys.stdout.flush()
+            os.dup2(console,1)
+            os.close(console)
+    return time.time() - t1
+
+# function to run a list of jobs on a process pool and log them to the ledger
+def run_stage(kind,jobs,ledger,workers):
+    failed = set()
+    if not jobs:
+        return failed
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job,kind,workdir,dns_fname): job
+                   for job,workdir,dns_fname in jobs}
+        for future in as_completed(futures):
+            job   = futures[future]
+            entry = {'kind': kind, 'job': job}
+            try:
+                entry['seconds'] = future.result()
+                entry['status']  = 'done'
+            except Exception as err:
+                entry['status']  = 'failed'
+                entry['error']   = repr(err)
+                failed.add(job)
+            ledger.write(json.dumps(entry)+"\n")
+            ledger.flush()
+            print("[pyBurgers: Sweep] \t %s %s %s"%(kind.upper(),entry['status'],job))
+    return failed
+
+# sweep driver
+def main(spec_fname):
+
+    # let's time this thing
+    t1 = time.time()
+
+    # read the sweep and base namelist
+    with open(spec_fname) as json_file:
+        spec = json.load(json_file)
+    with open(spec.get('namelist','namelist.json')) as json_file:
+        base = json.load(json_file)
+    mode    = spec.get('mode','both')
+    workers = spec.get('workers',os.cpu_count())
+    outdir  = spec.get('output','sweep')
+    os.makedirs(outdir,exist_ok=True)
+
+    # finished jobs from previous attempts
+    ledger_fname = os.path.join(outdir,'ledger.jsonl')
+    done = read_ledger(ledger_fname)
+
+    # lay out job directories, DNS runs shared between LES settings
+    dns_jobs = {}
+    les_jobs = []
+    for params,namelist in expand(base,spec.get('grid',{})):
+        dns_job = job_id('dns',params,namelist)
+        dns_dir = os.path.join(outdir,'dns',dns_job)
+        if dns_job not in dns_jobs:
+            dns_jobs[dns_job] = dns_dir
+            os.makedirs(dns_dir,exist_ok=True)
+            with open(os.path.join(dns_dir,'namelist.json'),'w') as f:
+                json.dump(namelist,f,indent=4)
+        if mode in ('les','both'):
+            les_job = job_id('les',params,namelist)
+            les_dir = os.path.join(outdir,'les',les_job)
+            os.makedirs(les_dir,exist_ok=True)
+            # every LES extracts its own training file
+            tau_file = namelist['les'].get('tau_file')
+            if tau_file:
+                namelist['les']['tau_file'] = os.path.join(les_dir,os.path.basename(tau_file))
+            with open(os.path.join(les_dir,'namelist.json'),'w') as f:
+                json.dump(namelist,f,indent=4)
+            les_jobs.append((les_job,les_dir,dns_job))
+
+    # skip runs recorded as done whose output is still there
+    def pending(kind,job,workdir):
+        return ((kind,job) not in done or
+                not os.path.exists(os.path.join(workdir,OUTPUT[kind])))
+
+    with open(ledger_fname,'a') as ledger:
+
+        # DNS runs first, LES runs train on their output
+        failed = set()
+        if mode in ('dns','both'):
+            jobs = [(job,workdir,None) for job,workdir in dns_jobs.items()
+                    if pending('dns',job,workdir)]
+            print("[pyBurgers: Sweep] \t Running %d of %d DNS jobs"%(len(jobs),len(dns_jobs)))
+            failed = run_stage('dns',jobs,ledger,workers)
+
+        if mode in ('les','both'):
+            jobs = [(job,workdir,os.path.join(dns_jobs[dns_job],OUTPUT['dns']))
+                    for job,workdir,dns_job in les_jobs
+                    if dns_job not in failed and pending('les',job,workdir)]
+            print("[pyBurgers: Sweep] \t Running %d of %d LES jobs"%(len(jobs),len(les_jobs)))
+            failed |= run_stage('les',jobs,ledger,workers)
+
+    # time info
+    t2 = time.time()
+    tt = t2 - t1
+    print("[pyBurgers: Sweep] \t Done! Completed in %0.2f seconds (%d failed)"%(tt,len(failed)))
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else 'sweep.json')